@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# Asynchronous (gevent) entry point to AppGateway
+#
+# Run as a standalone server:
+#   python AppGatewayAsync.py [port]
+# or with gunicorn:
+#   gunicorn -k gevent AppGatewayAsync:application
+
+# Monkey patching has to be done before any other import
+from gevent import monkey
+monkey.patch_all()
+
+# Setup PYTHONPATH for imports to work
+import sys
+sys.path.insert(0, "/var/www/wsgi/AppGateway")
+
+# Setup flask app as application to run by WSGI
+from CISAppGateway import app as application
+
+# Load the AppGateway configuration
+from CISAppGateway import Config
+Config.conf.load("/var/www/wsgi/AppGateway/AppGatewayProduction.json")
+Config.conf.setup_logging()
+
+# Run blocking file system operations in a thread pool
+from CISAppGateway import Async
+Async.setup()
+
+if __name__ == '__main__':
+    from gevent.pywsgi import WSGIServer
+    if len(sys.argv) > 1:
+        _port = int(sys.argv[1])
+    else:
+        _port = 5000
+    WSGIServer(('', _port), application).serve_forever()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# Migrate the shared storage from the flat layout to the sharded layout
+#
+# Usage:
+#   python AppGatewayShard.py <config file>
+#
+# The config file has to define the target layout (gate_shard_levels,
+# gate_shard_width). Migration procedure:
+#   1. Stop AppServer and reconfigure it to use the sharded layout.
+#   2. Enable gate_shard_levels and gate_shard_fallback in the AppGateway
+#      config and restart AppGateway (it keeps serving jobs from both
+#      layouts). The layout options are applied only on startup, a config
+#      reload keeps the old layout.
+#   3. Run this tool. It can be safely interrupted and run again.
+#   4. Disable gate_shard_fallback, restart AppGateway and start AppServer.
+#
+# Every entry is moved atomically (job files and opts files are linked or
+# renamed, symbolic links are replaced by new links pointing to the moved job
+# file), so each of them is always visible in at least one location.
+
+import os
+import sys
+import errno
+import logging
+
+from logging import info, warning
+
+from CISAppGateway import Storage
+from CISAppGateway.Config import conf
+
+
+def flat_entries(path):
+    """
+    Return names of entries of the flat layout present in a job directory.
+    """
+    return [_name for _name in os.listdir(path)
+            if not conf.is_shard(_name, 0)]
+
+
+def prepare(path):
+    """
+    Create hash-prefix subdirectory for a job entry path.
+    """
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def link_jobs():
+    """
+    Hard link job files into their hash-prefix subdirectories.
+    """
+    _ids = flat_entries(conf.gate_path_jobs)
+    for _id in _ids:
+        _path = conf.job_path(conf.gate_path_jobs, _id)
+        prepare(_path)
+        try:
+            os.link(os.path.join(conf.gate_path_jobs, _id), _path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    info("@AppGatewayShard - Linked %d job files" % len(_ids))
+    return _ids
+
+
+def move_links(path):
+    """
+    Replace symbolic links in a state or flag directory with links placed in
+    hash-prefix subdirectories and pointing to the moved job files.
+    """
+    _ids = flat_entries(path)
+    for _id in _ids:
+        _path = conf.job_path(path, _id)
+        _tmp = _path + '.shard'
+        prepare(_path)
+        try:
+            os.unlink(_tmp)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        os.symlink(conf.job_path(conf.gate_path_jobs, _id), _tmp)
+        os.rename(_tmp, _path)
+        os.unlink(os.path.join(path, _id))
+    info("@AppGatewayShard - Moved %d links in %s" % (len(_ids), path))
+
+
+def move_opts(ids):
+    """
+    Move files from the opts directory. Files are named after the job ID,
+    optionally with a prefix (e.g. message_<id>).
+    """
+    _count = 0
+    for _name in flat_entries(conf.gate_path_opts):
+        _id = job_id(_name, ids)
+        if _id is None:
+            warning("@AppGatewayShard - Unknown job of opts file: %s" %
+                    _name)
+            continue
+        _path = conf.job_path(conf.gate_path_opts, _id, _name)
+        prepare(_path)
+        os.rename(os.path.join(conf.gate_path_opts, _name), _path)
+        _count += 1
+    info("@AppGatewayShard - Moved %d opts files" % _count)
+
+
+def job_id(name, ids):
+    """
+    Return ID of the job an opts file belongs to or *None* if not found.
+    """
+    _idx = -1
+    while True:
+        if name[_idx + 1:] in ids:
+            return name[_idx + 1:]
+        _idx = name.find('_', _idx + 1)
+        if _idx < 0:
+            return None
+
+
+def unlink_jobs(ids):
+    """
+    Remove flat layout job files (already linked into hash-prefix
+    subdirectories).
+    """
+    for _id in ids:
+        os.unlink(os.path.join(conf.gate_path_jobs, _id))
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: %s <config file>" % sys.argv[0])
+        sys.exit(1)
+    conf.load(sys.argv[1])
+    if not conf.gate_shard_levels:
+        print("gate_shard_levels is not set in %s" % sys.argv[1])
+        sys.exit(1)
+
+    _ids = link_jobs()
+    for _path in [conf.gate_path_flag_delete, conf.gate_path_flag_stop,
+                  conf.gate_path_flag_old_api] + \
+            [conf.gate_path[_state] for _state in conf.service_states]:
+        move_links(_path)
+    move_opts(set(Storage.list_jobs(conf.gate_path_jobs)))
+    unlink_jobs(_ids)
+    info("@AppGatewayShard - Migration finished")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,270 @@
+"""
+Admission control of job submissions.
+
+Submissions are rejected when the backlog of jobs waiting for AppServer
+(jobs in states listed in gate_admission_limit) exceeds the configured limit
+for the service. Clients are asked to retry after the time needed to drain
+the excess at the recently observed rate. Optionally every client has a
+token bucket limiting its submission rate, so a single client can not fill
+the whole backlog.
+
+Backlog sizes come from :py:meth:`Backend.counts` (state index, database or
+sampled listings) refreshed every gate_admission_sample seconds by a
+background thread, so requests never wait for the shared storage to be
+listed. The thread is started by the first submission subject to a limit,
+until the first refresh finishes no backlog is known. Jobs submitted by this
+process since the last sample are added to the backlog of the "new" state.
+"""
+
+import math
+import time
+import threading
+
+from logging import debug, error, warning
+
+from CISAppGateway import Metrics
+from CISAppGateway.Backend import backend
+from CISAppGateway.Cache import LRUCache
+from CISAppGateway.Config import conf
+
+#: States of jobs waiting for AppServer (the drain rate is the rate at which
+#: jobs leave these states)
+BACKLOG_STATES = ('new', 'processing', 'waiting', 'queued')
+#: Weight of the latest measurement in the drain rate moving average
+RATE_WEIGHT = 0.3
+#: Minimal interval (in seconds) between refreshes of the background thread
+MIN_INTERVAL = 0.1
+
+rejected_count = Metrics.Counter(
+    'appgw_admission_rejected_total',
+    'Number of submissions rejected by the admission control.',
+    labels=('reason',),
+)
+
+
+class Rejection(object):
+    """
+    Reason of a rejected submission.
+    """
+    __slots__ = ('status', 'retry_after', 'message')
+
+    def __init__(self, status, retry_after, message):
+        #: HTTP status code
+        self.status = status
+        #: Number of seconds after which the client should retry
+        self.retry_after = retry_after
+        self.message = message
+
+
+class TokenBucket(object):
+    """
+    Submission rate limit of a single client.
+    """
+    __slots__ = ('tokens', 'time')
+
+    def __init__(self):
+        self.tokens = float(conf.gate_client_burst)
+        self.time = time.time()
+
+
+class AdmissionControl(object):
+    """
+    Tracks backlog of jobs per service, its drain rate and client token
+    buckets.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        #: Time of the last refresh of the backlog
+        self.time = 0.0
+        #: Time the backend counts were sampled at
+        self.sample_time = None
+        #: State -> service -> number of jobs (at sample_time)
+        self.counts = {}
+        #: Service -> number of jobs submitted by this process
+        self.submitted = {}
+        #: Copy of submitted at sample_time
+        self.sample_submitted = {}
+        #: Service -> number of jobs leaving the backlog per second
+        self.rates = {}
+        self.buckets = LRUCache(lambda: conf.gate_client_buckets)
+        self.buckets_lock = threading.Lock()
+        self.thread = None
+        self.thread_lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the thread refreshing backlog sizes. Does nothing if the thread
+        was already started.
+        """
+        with self.thread_lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run,
+                                           name="AdmissionRefresh")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        """
+        Refresh loop run by the background thread.
+        """
+        while True:
+            try:
+                self.refresh()
+            except:
+                error("@admit - Backlog refresh failed", exc_info=True)
+            time.sleep(max(conf.gate_admission_sample, MIN_INTERVAL))
+
+    def job_submitted(self, service):
+        """
+        Count job created by this process.
+        """
+        with self.lock:
+            self.submitted[service] = self.submitted.get(service, 0) + 1
+
+    def limits(self, service):
+        """
+        Return dict mapping states to backlog limits for a service.
+        """
+        return conf.gate_admission_limit.get(
+            service, conf.gate_admission_limit.get('default', {}))
+
+    def admit(self, services, client=None):
+        """
+        Check if jobs can be submitted.
+
+        :param services: list of service names of the submitted jobs (one
+            entry per job).
+        :param client: client identifier used for the rate limit.
+        :return: :py:class:`Rejection` or *None* if the jobs are accepted.
+        """
+        _rejection = self._check_backlog(services)
+        if _rejection is None and client is not None and \
+                conf.gate_client_rate > 0:
+            _rejection = self._take_tokens(client, len(services))
+        if _rejection is not None:
+            rejected_count.inc((
+                'backlog' if _rejection.status == 503 else 'client_rate',))
+        return _rejection
+
+    def _check_backlog(self, services):
+        _jobs = {}
+        for _service in services:
+            if self.limits(_service):
+                _jobs[_service] = _jobs.get(_service, 0) + 1
+        if not _jobs:
+            return None
+
+        if self.thread is None:
+            self.start()
+        _retry_after = 0
+        with self.lock:
+            for _service, _count in _jobs.items():
+                for _state, _limit in self.limits(_service).items():
+                    _excess = self.backlog(_service, _state) + _count - _limit
+                    if _excess > 0:
+                        _retry_after = max(_retry_after,
+                                           self.drain_time(_service, _excess))
+        if not _retry_after:
+            return None
+        debug("@admit - Backlog limit exceeded, retry after %d s",
+              _retry_after)
+        return Rejection(503, _retry_after,
+                         'Error: Service overloaded, retry later')
+
+    def backlog(self, service, state):
+        """
+        Return number of jobs of a service in a state. Has to be called with
+        the lock held.
+        """
+        _count = self.counts.get(state, {}).get(service, 0)
+        if state == 'new':
+            _count += self.submitted.get(service, 0) - \
+                self.sample_submitted.get(service, 0)
+        return _count
+
+    def drain_time(self, service, jobs):
+        """
+        Return number of seconds needed to drain jobs from the backlog of a
+        service. Has to be called with the lock held.
+        """
+        _rate = self.rates.get(service)
+        if not _rate:
+            return conf.gate_admission_retry_max
+        return int(min(max(math.ceil(jobs / _rate), 1),
+                       conf.gate_admission_retry_max))
+
+    def refresh(self):
+        """
+        Refresh backlog sizes and drain rates if they are older than
+        gate_admission_sample seconds. Called by the background thread.
+        """
+        if time.time() - self.time < conf.gate_admission_sample:
+            return
+        try:
+            _counts, _age = backend().counts()
+        except:
+            warning("@admit - Unable to count jobs", exc_info=True)
+            return
+        _now = time.time()
+        with self.lock:
+            self.time = _now
+            _sample_time = _now - _age
+            # Counts sampled by the backend are reused until the next sample
+            # (the sample time is only known approximately)
+            if self.sample_time is not None and \
+                    _sample_time - self.sample_time <= \
+                    0.5 * conf.gate_admission_sample:
+                return
+            if self.sample_time is not None:
+                self._update_rates(_counts, _sample_time - self.sample_time)
+            self.counts = _counts
+            self.sample_time = _sample_time
+            self.sample_submitted = dict(self.submitted)
+
+    def _update_rates(self, counts, interval):
+        _services = set(self.submitted)
+        for _state in BACKLOG_STATES:
+            _services.update(self.counts.get(_state, {}))
+        for _service in _services:
+            _before = _after = 0
+            for _state in BACKLOG_STATES:
+                _before += self.counts.get(_state, {}).get(_service, 0)
+                _after += counts.get(_state, {}).get(_service, 0)
+            # Jobs submitted by other AppGateway processes are not known, the
+            # rate can be underestimated
+            _drained = max(0, _before - _after + self.submitted.get(
+                _service, 0) - self.sample_submitted.get(_service, 0))
+            _rate = _drained / interval
+            _previous = self.rates.get(_service)
+            if _previous is not None:
+                _rate = RATE_WEIGHT * _rate + (1 - RATE_WEIGHT) * _previous
+            self.rates[_service] = _rate
+
+    def _take_tokens(self, client, count):
+        # Balance can drop below zero, so batches larger than the bucket are
+        # accepted and the client has to wait longer afterwards
+        with self.buckets_lock:
+            _bucket = self.buckets.get(client)
+            if _bucket is None:
+                _bucket = TokenBucket()
+                self.buckets.put(client, _bucket)
+            _now = time.time()
+            _bucket.tokens = min(
+                float(conf.gate_client_burst),
+                _bucket.tokens + (_now - _bucket.time) * conf.gate_client_rate
+            )
+            _bucket.time = _now
+            if _bucket.tokens >= 1:
+                _bucket.tokens -= count
+                return None
+            _retry_after = int(math.ceil(
+                (1 - _bucket.tokens) / conf.gate_client_rate))
+        debug("@admit - Client %s exceeded submission rate", client)
+        return Rejection(429, _retry_after,
+                         'Error: Too many requests, retry later')
+
+
+#: Global AdmissionControl instance
+admission = AdmissionControl()
@@ -0,0 +1,213 @@
+"""
+Structured responses of API version 3 and compression of response bodies.
+
+Clients select API version 3 responses by accepting :py:data:`MEDIA_TYPE`
+or with the "format" URL argument (e.g. /status/<id>?format=v3). The "api"
+argument and service_api only set the API version of submitted jobs, they
+do not change the response format. Version 3 responses are compact JSON
+documents, errors carry a machine readable code and a matching HTTP status.
+Other clients (and clients requesting ?format=legacy) get the legacy plain
+string responses.
+
+Bodies of responses larger than gate_compress_min_size bytes are compressed
+with brotli (when the brotli module is available) or gzip, depending on the
+encodings accepted by the client.
+"""
+
+import zlib
+
+try:
+    import json
+except:
+    import simplejson as json
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from flask import Response
+
+from CISAppGateway.Config import conf
+
+#: Legacy (plain string) response format
+LEGACY = 'legacy'
+#: API version 3 (structured) response format
+V3 = 'v3'
+#: Media type of API version 3 responses
+MEDIA_TYPE = 'application/vnd.cisappgateway.v3+json'
+#: Values of the "format" URL argument selecting the response format
+FORMATS = (LEGACY, V3)
+#: Legacy error messages (matched by substring) -> (error code, HTTP status)
+ERRORS = (
+    ('not found', 'not_found', 404),
+    ('did not finish', 'not_finished', 409),
+    ('No active job', 'not_active', 409),
+    ('Unsupported service', 'unsupported_service', 400),
+    ('Idempotency key reused', 'idempotency_conflict', 422),
+    ('too large', 'too_large', 413),
+    ('Too many', 'too_many', 400),
+    ('Missing', 'invalid_request', 400),
+    ('Invalid', 'invalid_request', 400),
+    ('Expected', 'invalid_request', 400),
+    ('Exception', 'internal', 500),
+    ('Unable', 'unavailable', 503),
+)
+#: Media types of compressible responses
+COMPRESSIBLE = ('text/', 'application/json', MEDIA_TYPE)
+
+#: Compact JSON encoder (uses the C accelerated one shot encoding)
+_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def response_format(request):
+    """
+    Return response format requested by the client.
+
+    :return: :py:data:`LEGACY`, :py:data:`V3` or *None* when an unsupported
+        format was requested.
+    """
+    _format = request.args.get('format')
+    if _format is not None:
+        if _format not in FORMATS:
+            return None
+        return _format
+    if MEDIA_TYPE in request.headers.get('Accept', ''):
+        return V3
+    return LEGACY
+
+
+def document(data, status=200):
+    """
+    Return API version 3 response holding JSON document.
+    """
+    return Response(_encoder.encode(data), status=status,
+                    mimetype=MEDIA_TYPE)
+
+
+def error(message, id=None):
+    """
+    Return API version 3 error response for a legacy error message.
+    """
+    _code, _status = error_code(message)
+    return error_document(_code, _status, message, id)
+
+
+def error_code(message):
+    """
+    Return tuple (error code, HTTP status) for a legacy error message.
+    """
+    for _pattern, _code, _status in ERRORS:
+        if _pattern in message:
+            return _code, _status
+    return 'error', 400
+
+
+def error_data(message):
+    """
+    Return API version 3 description of an error (used in documents
+    describing many jobs).
+    """
+    return {'error': error_code(message)[0], 'message': message}
+
+
+def error_document(code, status, message, id=None):
+    """
+    Return API version 3 error response.
+    """
+    _data = {'error': code, 'message': message}
+    if id is not None:
+        _data['id'] = id
+    return document(_data, status)
+
+
+def unsupported_format():
+    """
+    Return API version 3 error response for an unsupported response format.
+    """
+    return error_document(
+        'unsupported_format', 400,
+        'Error: Unsupported response format (supported: %s)' %
+        ', '.join(sorted(FORMATS)))
+
+
+def status_data(id, info):
+    """
+    Return API version 3 status of a job.
+
+    :param info: :py:class:`Server.StatusInfo`
+    """
+    if info.state is None:
+        return {'id': id, 'error': info.error, 'message': info.status}
+    _data = {'id': id, 'state': info.state, 'updated': info.mtime}
+    if info.terminal:
+        _data['message'] = info.status
+    return _data
+
+
+def watch_data(id, status):
+    """
+    Return API version 3 description of a watched job.
+
+    :param status: status string as returned by :py:func:`Server.status`
+        (*None* if not known).
+    """
+    if status is None or status.startswith('Error:'):
+        _data = error_data(status or 'Error: Unable to check job status')
+    else:
+        _data = {'status': status}
+    _data['id'] = id
+    return _data
+
+
+def compress(request, response):
+    """
+    Compress body of a response if the client accepts it. Streamed bodies are
+    compressed on the fly. Responses sent as files, partial content, event
+    streams (would be delayed by compression) and small bodies are left
+    intact.
+    """
+    _min_size = conf.gate_compress_min_size
+    if not _min_size or response.status_code != 200 or \
+            response.direct_passthrough or \
+            'Content-Encoding' in response.headers or \
+            not response.mimetype.startswith(COMPRESSIBLE) or \
+            response.mimetype == 'text/event-stream':
+        return response
+    if response.content_length is not None and \
+            response.content_length < _min_size:
+        return response
+
+    _accepted = request.accept_encodings
+    if brotli is not None and _accepted['br']:
+        _encoding = 'br'
+        _compressor = brotli.Compressor(quality=conf.gate_compress_level)
+        _compress, _flush = _compressor.process, _compressor.finish
+    elif _accepted['gzip']:
+        _encoding = 'gzip'
+        _compressor = zlib.compressobj(conf.gate_compress_level,
+                                       zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        _compress, _flush = _compressor.compress, _compressor.flush
+    else:
+        return response
+
+    _body = response.iter_encoded()
+    if hasattr(response.response, 'close'):
+        response.call_on_close(response.response.close)
+    response.response = _compressed(_body, _compress, _flush)
+    response.headers.pop('Content-Length', None)
+    response.headers['Content-Encoding'] = _encoding
+    response.vary.add('Accept-Encoding')
+    # The compressed body differs from the identity one
+    _etag, _weak = response.get_etag()
+    if _etag is not None:
+        response.set_etag(_etag, weak=True)
+    return response
+
+
+def _compressed(body, compress, flush):
+    for _chunk in body:
+        _data = compress(_chunk)
+        if _data:
+            yield _data
+    yield flush()
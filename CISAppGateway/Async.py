@@ -0,0 +1,73 @@
+"""
+Support for running AppGateway on the gevent asynchronous server.
+
+Requests are handled by greenlets, so idle connections (e.g. long-poll watch
+requests) are cheap. Blocking file system operations (see
+:py:mod:`CISAppGateway.Storage`) are executed by a bounded pool of OS threads
+with a separate concurrency limit for every file system (the shared storage
+and jobs output of every volume have their own limits). gevent monkey
+patching has to be applied before CISAppGateway is imported, see
+AppGatewayAsync.py.
+"""
+
+from logging import debug
+
+from gevent.lock import BoundedSemaphore
+from gevent.threadpool import ThreadPool
+
+from CISAppGateway import Index, Storage
+from CISAppGateway.Config import conf
+
+
+class ThreadPoolExecutor(object):
+    """
+    Run blocking operations in a bounded thread pool.
+    """
+
+    def __init__(self, size, limits):
+        """
+        :param size: number of threads in the pool.
+        :param limits: dict mapping file system keys to maximum number of
+            concurrent operations. Volume file systems ("shared:<name>")
+            without their own limit use the limit of their kind ("shared").
+        """
+        self.pool = ThreadPool(size)
+        self.size = size
+        self.limits = dict(limits)
+        #: File system key -> semaphore limiting its concurrent operations
+        #: (created on first use, volumes can be added by config reloads)
+        self.semaphores = {}
+
+    def semaphore(self, fs):
+        """
+        Return semaphore limiting concurrent operations on a file system.
+        """
+        _semaphore = self.semaphores.get(fs)
+        if _semaphore is None:
+            _limit = self.limits.get(
+                fs, self.limits.get(fs.split(':', 1)[0], self.size))
+            _semaphore = self.semaphores.setdefault(
+                fs, BoundedSemaphore(_limit))
+        return _semaphore
+
+    def run(self, fs, func, *args, **kwargs):
+        """
+        Run func in the thread pool and wait for the result. Only the calling
+        greenlet is blocked.
+        """
+        with self.semaphore(fs):
+            return self.pool.apply(func, args, kwargs)
+
+
+def setup():
+    """
+    Install the thread pool executor for blocking operations. Should be called
+    after the configuration is loaded.
+    """
+    debug("@Async - Thread pool size: %s, limits: %s" %
+          (conf.gate_async_threads, conf.gate_async_limits))
+    # pyinotify notifier thread relies on blocking poll() not supported by
+    # gevent, state index is updated by rescans only
+    Index.INOTIFY = False
+    Storage.executor = ThreadPoolExecutor(conf.gate_async_threads,
+                                          conf.gate_async_limits)
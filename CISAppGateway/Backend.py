@@ -0,0 +1,743 @@
+"""
+Backends storing states and flags of jobs.
+
+:py:class:`SymlinkBackend` (default) uses the protocol understood by
+CISAppServer: a job file in the jobs directory and symbolic links to it in the
+state and flag directories of the shared storage. :py:class:`SQLiteBackend`
+keeps job records in an SQLite database in WAL mode, so checking the state of
+a job is a single indexed query. For AppServer versions that use the symbolic
+link protocol it mirrors new jobs and flags to the shared storage and
+periodically imports state changes back.
+
+Job files and job exit messages (opts directory) are kept on the shared
+storage regardless of the backend.
+"""
+
+import os
+import time
+import errno
+import threading
+
+from logging import debug, error, info
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from CISAppGateway import Storage
+from CISAppGateway.Config import conf
+from CISAppGateway.Index import index, job_service, STATE_PRIORITY, FLAGS
+
+
+class StoredJob(object):
+    """
+    View of job existence, flags and state that checks the shared storage.
+    Each check is performed only when requested.
+    """
+
+    def __init__(self, id):
+        self.id = id
+
+    def exists(self):
+        """Check if job file is present in jobs subdir."""
+        return entry_exists(conf.gate_path_jobs, self.id, Storage.isfile)
+
+    def flag(self, name):
+        """Check if job has flag *name* (delete, stop, old_api) set."""
+        return entry_exists(os.path.join(conf.gate_path_flags, name), self.id)
+
+    def state(self, states=STATE_PRIORITY):
+        """
+        Return first of *states* the job is in or *None* if job is in none of
+        them.
+        """
+        for _state in states:
+            if entry_exists(conf.gate_path[_state], self.id):
+                return _state
+        return None
+
+
+class IndexedJob(object):
+    """
+    View of job existence, flags and state that were already determined, e.g.
+    by the state index lookup.
+    """
+
+    def __init__(self, id, state, flags):
+        self.id = id
+        self._state = state
+        self._flags = flags
+
+    def exists(self):
+        return True
+
+    def flag(self, name):
+        return name in self._flags
+
+    def state(self, states=STATE_PRIORITY):
+        if self._state in states:
+            return self._state
+        return None
+
+
+class MissingJob(object):
+    """
+    View of a job that does not exist.
+    """
+
+    def __init__(self, id):
+        self.id = id
+
+    def exists(self):
+        return False
+
+    def flag(self, name):
+        return False
+
+    def state(self, states=STATE_PRIORITY):
+        return None
+
+
+def entry_exists(path, id, check=Storage.exists):
+    """
+    Check if entry of job id is present in a job directory (see
+    :py:meth:`Config.job_path`).
+    """
+    for _path in conf.job_paths(path, id):
+        if check(_path):
+            return True
+    return False
+
+
+def entry_stat(path, id):
+    """
+    Return lstat of entry of job id in a job directory or *None* if it is not
+    present.
+    """
+    for _path in conf.job_paths(path, id):
+        try:
+            return Storage.lstat(_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return None
+
+
+def read_entry(path, id, name, read):
+    """
+    Call read with path of an entry of job id in a job directory. Fallback
+    locations (see :py:meth:`Config.job_paths`) are tried when the entry does
+    not exist.
+
+    :return: value returned by read.
+    """
+    _paths = conf.job_paths(path, id, name)
+    for _path in _paths[:-1]:
+        try:
+            return read(_path)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return read(_paths[-1])
+
+
+def list_jobs(path):
+    """
+    Return names of job entries in a job directory of the default volume and
+    in the corresponding directories of other volumes (see
+    :py:meth:`Config.volume_dirs`).
+    """
+    _result = []
+    for _path in conf.volume_dirs(path):
+        _result.extend(Storage.list_jobs(_path))
+    return _result
+
+
+def _present(path, ids):
+    """
+    Return subset of ids that have entries in a job directory. Every
+    directory (every hash-prefix subdirectory holding entries of the ids for
+    the sharded layout) is listed once.
+    """
+    if not conf.gate_shard_levels and not conf.gate_volumes:
+        return ids.intersection(Storage.listdir(path))
+    _dirs = {}
+    for _id in ids:
+        _dir = os.path.dirname(conf.job_path(path, _id))
+        _dirs.setdefault(_dir, set()).add(_id)
+        if conf.gate_shard_levels and conf.gate_shard_fallback:
+            _dirs.setdefault(conf.volume_path(path, _id), set()).add(_id)
+    _found = set()
+    for _dir, _ids in _dirs.items():
+        try:
+            _found.update(_ids.intersection(Storage.listdir(_dir)))
+        except OSError as e:
+            # Subdirectories are created along with the first entry
+            if e.errno != errno.ENOENT:
+                raise
+    return _found
+
+
+class SymlinkBackend(object):
+    """
+    Job states and flags stored as symbolic links on the shared storage. The
+    state index is used for lookups when enabled.
+    """
+
+    def __init__(self):
+        #: Last sample of number of jobs per state and service (used when the
+        #: state index is disabled)
+        self.counts_sample = {'time': 0, 'counts': {}}
+        self.counts_lock = threading.Lock()
+
+    def job(self, id):
+        """
+        Return view of the job identified by id. The state index is used when
+        enabled, shared storage is checked only on an index miss.
+        """
+        if conf.gate_state_index:
+            try:
+                _record = index.lookup(id)
+            except:
+                error("@SymlinkBackend - State index lookup failed",
+                      exc_info=True)
+                _record = None
+            if _record is not None:
+                return IndexedJob(id, *_record)
+        return StoredJob(id)
+
+    def forget(self, id):
+        """
+        Drop entries of job id that the state index holds but the shared
+        storage no longer has (e.g. the job was removed by AppServer since the
+        last rescan).
+
+        :return: *True* if any entry was dropped.
+        """
+        if not conf.gate_state_index:
+            return False
+        _dropped = False
+        for _key in ('jobs',) + FLAGS + STATE_PRIORITY:
+            if index.contains(_key, id) and \
+                    not entry_exists(index.path(_key), id):
+                index.discard(_key, id)
+                _dropped = True
+        return _dropped
+
+    def jobs(self, ids):
+        """
+        Return views of many jobs at once.
+
+        Instead of checking every job separately each state and flag
+        directory is listed at most once and its contents are intersected
+        with the set of requested jobs. Fewer than gate_lookup_batch_min jobs
+        (e.g. a few jobs polled by the watcher) are checked separately, which
+        is cheaper than listing large directories. Jobs found in the state
+        index are not looked up on the shared storage at all.
+
+        :param ids: set of job IDs
+        :return: dict mapping job IDs to job views. Jobs that were not found
+            are omitted.
+        """
+        _result = {}
+        _pending = set()
+        for _id in ids:
+            _job = self.job(_id)
+            if isinstance(_job, IndexedJob):
+                _result[_id] = _job
+            else:
+                _pending.add(_id)
+        if not _pending:
+            return _result
+
+        if len(_pending) < conf.gate_lookup_batch_min:
+            for _id in _pending:
+                _job = StoredJob(_id)
+                _state = _job.state()
+                if _state is not None:
+                    _result[_id] = IndexedJob(_id, _state, frozenset(
+                        _flag for _flag in FLAGS if _job.flag(_flag)
+                    ))
+            return _result
+
+        _flags = dict(
+            (_flag, _present(os.path.join(conf.gate_path_flags, _flag),
+                             _pending))
+            for _flag in FLAGS
+        )
+        # Presence in a state directory implies existence of the job file
+        for _state in STATE_PRIORITY:
+            if not _pending:
+                break
+            _found = _present(conf.gate_path[_state], _pending)
+            _pending.difference_update(_found)
+            for _id in _found:
+                _result[_id] = IndexedJob(_id, _state, frozenset(
+                    _flag for _flag in FLAGS if _id in _flags[_flag]
+                ))
+        return _result
+
+    def find(self, states, service=None, prefix=None, before=None):
+        """
+        Find jobs in states matching a filter. Every state directory is
+        listed once (the state index is used instead when enabled) and flags
+        are checked only for the matching jobs.
+
+        :param states: job states to search.
+        :param service: return only jobs of the service.
+        :param prefix: return only jobs with IDs starting with prefix.
+        :param before: return only jobs submitted before this time (mtime of
+            the job file is checked for the matching jobs).
+        :return: dict mapping job IDs to job views.
+        """
+        _matched = {}
+        # Job present in more than one state directory is assigned the state
+        # with the highest priority
+        for _state in STATE_PRIORITY:
+            if _state not in states:
+                continue
+            if conf.gate_state_index:
+                _ids = index.members(_state)
+            else:
+                _ids = list_jobs(conf.gate_path[_state])
+            for _id in _ids:
+                if _id in _matched or \
+                        service is not None and job_service(_id) != service \
+                        or prefix is not None and not _id.startswith(prefix):
+                    continue
+                _matched[_id] = _state
+
+        if before is not None:
+            for _id in list(_matched):
+                _stat = entry_stat(conf.gate_path_jobs, _id)
+                if _stat is None or _stat.st_mtime >= before:
+                    del _matched[_id]
+
+        if conf.gate_state_index:
+            _flags = dict(
+                (_flag, set(_id for _id in _matched
+                            if index.contains(_flag, _id)))
+                for _flag in FLAGS
+            )
+        else:
+            _flags = dict(
+                (_flag, _present(os.path.join(conf.gate_path_flags, _flag),
+                                 set(_matched)))
+                for _flag in FLAGS
+            )
+        return dict(
+            (_id, IndexedJob(_id, _state, frozenset(
+                _flag for _flag in FLAGS if _id in _flags[_flag]
+            )))
+            for _id, _state in _matched.items()
+        )
+
+    def deleted(self, id, validate=True):
+        """
+        Check if job was marked for removal.
+
+        :param validate: check the shared storage. Otherwise only the state
+            index is checked (when enabled).
+        :return: *None* if it was not checked.
+        """
+        _deleted = None
+        if conf.gate_state_index:
+            _deleted = index.contains('delete', id)
+        if _deleted is None and validate:
+            _deleted = entry_exists(conf.gate_path_flag_delete, id)
+        return _deleted
+
+    def create(self, id, path, flags=()):
+        """
+        Add a new job to the queue.
+
+        :param path: path to the job file.
+        :param flags: names of flags to set. Flags are set before the job is
+            queued.
+        """
+        for _flag in flags:
+            Storage.symlink_job(
+                path,
+                conf.job_path(os.path.join(conf.gate_path_flags, _flag), id)
+            )
+            index.add(_flag, id)
+        Storage.symlink_job(path, conf.job_path(conf.gate_path_new, id))
+        index.add('jobs', id)
+        index.add('new', id)
+
+    def set_flag(self, name, ids):
+        """
+        Set flag *name* (delete, stop) for jobs. Flags that already exist
+        (e.g. set concurrently by another request) count as set, a failure
+        for one job does not stop the remaining ones.
+
+        :return: list of IDs of jobs whose flag could not be set.
+        """
+        _failed = []
+        for _id in ids:
+            try:
+                Storage.symlink_job(
+                    conf.job_path(conf.gate_path_jobs, _id),
+                    conf.job_path(os.path.join(conf.gate_path_flags, name),
+                                  _id)
+                )
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    error("@SymlinkBackend - Unable to set %s flag of job %s",
+                          name, _id, exc_info=True)
+                    _failed.append(_id)
+                    continue
+            index.add(name, _id)
+        return _failed
+
+    def counts(self):
+        """
+        Return number of jobs per service in every state directory. The
+        numbers come from the state index when it is used. Otherwise state
+        directories are listed at most once per gate_metrics_sample seconds.
+
+        :return: tuple (counts, age) where counts is a dict mapping states to
+            dicts mapping service names to number of jobs and age is the age
+            of the data in seconds.
+        """
+        if conf.gate_state_index and index.started:
+            return dict(
+                (_state, index.service_counts(_state))
+                for _state in conf.service_states
+            ), 0.0
+
+        with self.counts_lock:
+            if time.time() - self.counts_sample['time'] >= \
+                    conf.gate_metrics_sample:
+                _counts = {}
+                for _state in conf.service_states:
+                    _services = _counts[_state] = {}
+                    for _id in list_jobs(conf.gate_path[_state]):
+                        _service = job_service(_id)
+                        _services[_service] = _services.get(_service, 0) + 1
+                self.counts_sample['counts'] = _counts
+                self.counts_sample['time'] = time.time()
+            return self.counts_sample['counts'], \
+                time.time() - self.counts_sample['time']
+
+
+class SQLiteBackend(object):
+    """
+    Job states and flags stored in an SQLite database in WAL mode.
+
+    Every thread uses its own connection. Queries are run as blocking
+    operations (see :py:func:`Storage.offload`). When gate_backend_mirror is
+    enabled new jobs and flags are also written to the shared storage using
+    :py:class:`SymlinkBackend` and states set by AppServer are imported every
+    gate_backend_sync seconds.
+    """
+
+    #: Columns holding job flags (in the order of :py:data:`Index.FLAGS`)
+    FLAG_COLUMNS = tuple('flag_' + _flag for _flag in FLAGS)
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS jobs ('
+        ' id TEXT PRIMARY KEY,'
+        ' service TEXT NOT NULL,'
+        ' state TEXT NOT NULL,' +
+        ''.join(' %s INTEGER NOT NULL DEFAULT 0,' % _column
+                for _column in FLAG_COLUMNS) +
+        ' created REAL NOT NULL,'
+        ' updated REAL NOT NULL'
+        ')',
+        'CREATE INDEX IF NOT EXISTS jobs_state_service '
+        'ON jobs (state, service)',
+        'CREATE INDEX IF NOT EXISTS jobs_service ON jobs (service)',
+    )
+
+    #: Maximum number of parameters of a single query
+    BATCH = 500
+
+    def __init__(self):
+        if sqlite3 is None:
+            raise ImportError("sqlite3 module is not available")
+        self.local = threading.local()
+        self.mirror = None
+        self.thread = None
+        debug("@SQLiteBackend - Using database: %s" % conf.gate_path_database)
+        Storage.offload(Storage.DATABASE, self._create_schema)
+        if conf.gate_backend_mirror:
+            self.mirror = SymlinkBackend()
+            info("@SQLiteBackend - Importing job states from shared storage")
+            self.sync()
+            self.thread = threading.Thread(target=self.run,
+                                           name="SQLiteBackendSync")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def connection(self):
+        """
+        Return database connection of the current thread.
+        """
+        _connection = getattr(self.local, 'connection', None)
+        if _connection is None:
+            _connection = sqlite3.connect(conf.gate_path_database, timeout=30)
+            _connection.execute('PRAGMA journal_mode=WAL')
+            _connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = _connection
+        return _connection
+
+    def _create_schema(self):
+        with self.connection() as _connection:
+            for _statement in self.SCHEMA:
+                _connection.execute(_statement)
+
+    def job(self, id):
+        """
+        Return view of the job identified by id.
+        """
+        _jobs = self.jobs((id,))
+        return _jobs.get(id) or MissingJob(id)
+
+    def forget(self, id):
+        """
+        Stale records of removed jobs are dropped by :py:meth:`sync`.
+
+        :return: *False*
+        """
+        return False
+
+    def jobs(self, ids):
+        """
+        Return views of many jobs at once.
+
+        :param ids: set of job IDs
+        :return: dict mapping job IDs to job views. Jobs that were not found
+            are omitted.
+        """
+        _result = {}
+        for _id, _state, _flags in Storage.offload(
+                Storage.DATABASE, self._select, list(ids)):
+            _result[_id] = IndexedJob(_id, _state, _flags)
+        return _result
+
+    def _select(self, ids):
+        _query = 'SELECT id, state, %s FROM jobs WHERE id IN (%%s)' % \
+            ', '.join(self.FLAG_COLUMNS)
+        _result = []
+        _connection = self.connection()
+        for _idx in range(0, len(ids), self.BATCH):
+            _ids = ids[_idx:_idx + self.BATCH]
+            for _row in _connection.execute(
+                    _query % ', '.join('?' * len(_ids)), _ids):
+                _result.append((_row[0], _row[1], frozenset(
+                    _flag for _flag, _set in zip(FLAGS, _row[2:]) if _set
+                )))
+        return _result
+
+    def find(self, states, service=None, prefix=None, before=None):
+        """
+        Find jobs in states matching a filter with a single query.
+
+        :return: dict mapping job IDs to job views (see
+            :py:meth:`SymlinkBackend.find`, submission time is the time the
+            job was added to the database).
+        """
+        _result = {}
+        for _id, _state, _flags in Storage.offload(
+                Storage.DATABASE, self._find, list(states), service, prefix,
+                before):
+            _result[_id] = IndexedJob(_id, _state, _flags)
+        return _result
+
+    def _find(self, states, service, prefix, before):
+        _query = 'SELECT id, state, %s FROM jobs WHERE state IN (%s)' % (
+            ', '.join(self.FLAG_COLUMNS), ', '.join('?' * len(states)))
+        _args = list(states)
+        if service is not None:
+            _query += ' AND service = ?'
+            _args.append(service)
+        if prefix is not None:
+            _query += ' AND substr(id, 1, ?) = ?'
+            _args.extend((len(prefix), prefix))
+        if before is not None:
+            _query += ' AND created < ?'
+            _args.append(before)
+        return [
+            (_row[0], _row[1], frozenset(
+                _flag for _flag, _set in zip(FLAGS, _row[2:]) if _set
+            ))
+            for _row in self.connection().execute(_query, _args)
+        ]
+
+    def deleted(self, id, validate=True):
+        """
+        Check if job was marked for removal (or removed).
+
+        :param validate: query the database, otherwise *None* is returned.
+        """
+        if not validate:
+            return None
+        _job = self.job(id)
+        return not _job.exists() or _job.flag('delete')
+
+    def create(self, id, path, flags=()):
+        """
+        Add a new job to the queue.
+
+        :param path: path to the job file.
+        :param flags: names of flags to set.
+        """
+        if self.mirror is not None:
+            self.mirror.create(id, path, flags)
+        Storage.offload(Storage.DATABASE, self._insert, id, flags)
+
+    def _insert(self, id, flags):
+        _now = time.time()
+        with self.connection() as _connection:
+            _connection.execute(
+                'INSERT INTO jobs (id, service, state, %s, created, updated) '
+                'VALUES (?, ?, ?, %s, ?, ?)' % (
+                    ', '.join(self.FLAG_COLUMNS),
+                    ', '.join('?' * len(FLAGS))),
+                (id, job_service(id), 'new') +
+                tuple(int(_flag in flags) for _flag in FLAGS) +
+                (_now, _now)
+            )
+
+    def set_flag(self, name, ids):
+        """
+        Set flag *name* (delete, stop) for jobs. All jobs are updated in a
+        single transaction, jobs whose flag could not be mirrored to the
+        shared storage are left out.
+
+        :return: list of IDs of jobs whose flag could not be set.
+        """
+        _failed = []
+        if self.mirror is not None:
+            _failed = self.mirror.set_flag(name, ids)
+        Storage.offload(Storage.DATABASE, self._update_flag, name,
+                        [_id for _id in ids if _id not in _failed])
+        return _failed
+
+    def _update_flag(self, name, ids):
+        _now = time.time()
+        with self.connection() as _connection:
+            _connection.executemany(
+                'UPDATE jobs SET flag_%s = 1, updated = ? WHERE id = ?' %
+                FLAGS[FLAGS.index(name)],
+                [(_now, _id) for _id in ids]
+            )
+
+    def counts(self):
+        """
+        Return number of jobs per service in every state.
+
+        :return: tuple (counts, age) as :py:meth:`SymlinkBackend.counts`.
+        """
+        _counts = dict((_state, {}) for _state in conf.service_states)
+        for _state, _service, _count in Storage.offload(
+                Storage.DATABASE, self._count):
+            _counts.setdefault(_state, {})[_service] = _count
+        return _counts, 0.0
+
+    def _count(self):
+        return self.connection().execute(
+            'SELECT state, service, COUNT(*) FROM jobs '
+            'GROUP BY state, service'
+        ).fetchall()
+
+    def run(self):
+        """
+        Synchronization loop run by a background thread.
+        """
+        while True:
+            time.sleep(conf.gate_backend_sync)
+            try:
+                self.sync()
+            except:
+                error("@SQLiteBackend - Synchronization failed",
+                      exc_info=True)
+
+    def sync(self):
+        """
+        Import states and flags of jobs from the shared storage. Jobs removed
+        from the shared storage are removed from the database. Records
+        modified by AppGateway after the synchronization started are left
+        intact.
+        """
+        _start = time.time()
+        _states = {}
+        # Job present in more than one state directory is assigned the state
+        # with the highest priority
+        for _state in reversed(STATE_PRIORITY):
+            for _id in list_jobs(conf.gate_path[_state]):
+                _states[_id] = _state
+        _flags = dict(
+            (_flag, set(list_jobs(os.path.join(conf.gate_path_flags, _flag))))
+            for _flag in FLAGS
+        )
+        _records = {}
+        for _id in list_jobs(conf.gate_path_jobs):
+            if _id in _states:
+                _records[_id] = (_states[_id],) + tuple(
+                    int(_id in _flags[_flag]) for _flag in FLAGS)
+        _changes = Storage.offload(Storage.DATABASE, self._sync, _records,
+                                   _start)
+        debug("@SQLiteBackend - Synchronized %d jobs, %d changes" %
+              (len(_records), _changes))
+
+    def _sync(self, records, start):
+        _columns = ('state',) + self.FLAG_COLUMNS
+        with self.connection() as _connection:
+            _current = dict(
+                (_row[0], tuple(_row[1:])) for _row in _connection.execute(
+                    'SELECT id, %s FROM jobs WHERE updated < ?' %
+                    ', '.join(_columns), (start,))
+            )
+            _update = [
+                _record + (start, _id, start)
+                for _id, _record in records.items()
+                if _id in _current and _current[_id] != _record
+            ]
+            _insert = [
+                (_id, job_service(_id)) + _record + (start, start)
+                for _id, _record in records.items() if _id not in _current
+            ]
+            _delete = [
+                (_id, start) for _id in _current if _id not in records
+            ]
+            _connection.executemany(
+                'UPDATE jobs SET %s, updated = ? WHERE id = ? AND '
+                'updated < ?' % ', '.join('%s = ?' % _column
+                                          for _column in _columns),
+                _update
+            )
+            _connection.executemany(
+                'INSERT OR IGNORE INTO jobs (id, service, %s, created, '
+                'updated) VALUES (?, ?, %s, ?, ?)' % (
+                    ', '.join(_columns), ', '.join('?' * len(_columns))),
+                _insert
+            )
+            _connection.executemany(
+                'DELETE FROM jobs WHERE id = ? AND updated < ?', _delete)
+        return len(_update) + len(_insert) + len(_delete)
+
+
+#: Available backends (selected with gate_backend)
+BACKENDS = {
+    'symlink': SymlinkBackend,
+    'sqlite': SQLiteBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def backend():
+    """
+    Return instance of the backend selected by gate_backend. The backend is
+    created on first use (after the configuration is loaded).
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = BACKENDS[conf.gate_backend]()
+    return _backend
@@ -0,0 +1,86 @@
+"""
+Bounded in-memory caches.
+"""
+
+import threading
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Mapping with a maximum number of entries. When the cache is full the least
+    recently used entry is evicted. Counts hits, misses and evictions.
+    """
+
+    def __init__(self, size):
+        """
+        :param size: maximum number of entries (0 disables the cache) or a
+            callable returning it (allows to create cache before the
+            configuration is loaded).
+        """
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        """
+        Return value stored for key and mark it as recently used.
+        """
+        with self.lock:
+            try:
+                _value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data[key] = _value
+            self.hits += 1
+            return _value
+
+    @property
+    def max_size(self):
+        """
+        Maximum number of entries.
+        """
+        if callable(self.size):
+            return self.size()
+        return self.size
+
+    def put(self, key, value):
+        """
+        Store value for key evicting least recently used entries if needed.
+        """
+        _max_size = self.max_size
+        if _max_size <= 0:
+            return
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > _max_size:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        """
+        Remove entry for key and return its value.
+        """
+        with self.lock:
+            return self.data.pop(key, default)
+
+    def stats(self):
+        """
+        Return dict with cache size and counters.
+        """
+        return {
+            'size': len(self.data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -6,16 +6,67 @@ Global configuration for CISAppGateway.
 
 import os
 import re
+import time
+import hashlib
+import logging
+import threading
 try:
     import json
 except:
     import simplejson as json
 
 from logging import \
-    debug, log
+    debug, error, info, log, warning
+
+from CISAppGateway.Trace import TRACE_LOGGER
 
 VERBOSE = 5
 
+#: Valid names of shared storage volumes (used as Job ID suffixes)
+VOLUME_NAME_RE = re.compile(r'^[A-Za-z0-9-]+$')
+#: Strings (group 1) and comments of commented JSON. Strings are matched, so
+#: comment markers inside them are left intact.
+COMMENT_RE = re.compile(
+    r'("[^"\\]*(?:\\.[^"\\]*)*")|/\*.*?\*/|//[^\n]*',
+    re.DOTALL
+)
+#: Options applied only on startup, their changes are ignored by config
+#: reloads
+RESTART_OPTIONS = (
+    'gate_backend', 'gate_path_database', 'gate_path_shared',
+    'gate_path_output', 'gate_volumes', 'gate_shard_levels',
+    'gate_shard_width', 'gate_state_index', 'gate_state_index_inotify',
+    'gate_async_threads', 'gate_async_limits', 'gate_config_reload',
+)
+
+#: Handler writing to log_output (installed by Config.setup_logging)
+_log_handler = None
+#: Logging was configured by Config.setup_logging
+_logging_configured = False
+
+
+class Volume(object):
+    """
+    Shared storage volume: state tree used to communicate with an AppServer
+    instance and the root directory of jobs output.
+    """
+    __slots__ = ('name', 'shared', 'output', 'url_output', 'accel_prefix')
+
+    def __init__(self, name, shared, output, url_output, accel_prefix):
+        #: Volume name ("" for the default volume)
+        self.name = name
+        #: Path to the shared storage root (gate_path_shared)
+        self.shared = shared
+        #: Path to the jobs output root (gate_path_output)
+        self.output = output
+        #: URL where output files are accessible to users
+        self.url_output = url_output
+        #: Prefix of X-Accel-Redirect paths of output files
+        self.accel_prefix = accel_prefix
+
+    def __repr__(self):
+        return 'Volume(%r, %r, %r)' % (self.name, self.shared, self.output)
+
 
 class Config(dict):
     """
@@ -54,6 +105,62 @@ class Config(dict):
         self.service_api = 2.0
         #: Supported services
         self.allowed_services = ('Test', 'MultiNest', 'EPRCore')
+        #: Maximum number of requests accepted in a single batch submission
+        self.gate_submit_batch_max = 10000
+        #: Number of jobs flagged at once by bulk kill and delete requests
+        self.gate_bulk_batch = 500
+        #: Maximum size (in bytes) of a streamed job request per service
+        #: ("default" applies to services that are not listed and has to be
+        #: defined)
+        self.gate_submit_max_size = {"default": 16777216}
+        #: Maximum number of idempotency keys of submissions remembered to
+        #: return the same Job ID for repeated requests (0 disables the cache)
+        self.gate_idempotency_cache = 10000
+        #: Flush job files to disk before they are published
+        self.gate_submit_fsync = False
+        #: Limits of the number of jobs waiting for AppServer per service and
+        #: state ("new", "processing", "waiting", "queued"), e.g.
+        #: {"default": {"new": 1000}}. Submissions exceeding a limit are
+        #: rejected with 503 status ("default" applies to services that are
+        #: not listed, no limits by default)
+        self.gate_admission_limit = {}
+        #: Interval (in seconds) between refreshes of the job counts used by
+        #: the admission control (performed by a background thread)
+        self.gate_admission_sample = 1
+        #: Maximum time (in seconds) clients are asked to wait before
+        #: retrying rejected submissions (used when the drain rate is unknown)
+        self.gate_admission_retry_max = 300
+        #: Number of submissions per second allowed for a single client (0
+        #: disables the limit)
+        self.gate_client_rate = 0
+        #: Number of submissions a client can make at once (token bucket size)
+        self.gate_client_burst = 100
+        #: Maximum number of clients tracked by the submission rate limit
+        self.gate_client_buckets = 10000
+        #: Request header holding the client address set by a reverse proxy,
+        #: e.g. "X-Forwarded-For" (used only for requests coming from
+        #: gate_trusted_proxies). Authenticated clients are identified by the
+        #: user name (REMOTE_USER) instead
+        self.gate_client_header = None
+        #: Addresses of reverse proxies whose gate_client_header is trusted
+        self.gate_trusted_proxies = []
+        #: Retention age (in seconds) of finished jobs per service, e.g.
+        #: {"default": 604800}. Older jobs are marked for removal ("default"
+        #: applies to services that are not listed, jobs are kept by
+        #: default)
+        self.gate_retention = {}
+        #: Interval (in seconds) between retention sweeps
+        self.gate_retention_interval = 60
+        #: Maximum number of jobs marked for removal per second by the
+        #: retention sweeper (0 disables the limit)
+        self.gate_retention_rate = 10
+        #: Maximum number of jobs marked for removal by a single retention
+        #: sweep
+        self.gate_retention_max = 1000
+        #: Lock file taken by the process running the retention sweeper, only
+        #: one process sweeps at a time (None - retention.lock in
+        #: gate_path_shared)
+        self.gate_retention_lock = None
         #: URL where output files are accessible to users
         self.gate_url_output = 'http://localhost:8000/'
         #: Path to the shared storage used as communication medium with
@@ -61,8 +168,125 @@ class Config(dict):
         self.gate_path_shared = 'Shared'
         #: Path where jobs output will be stored
         self.gate_path_output = 'Output'
+        #: Additional shared storage volumes, e.g. {"b": {"shared":
+        #: "/mnt/b/Shared", "output": "/mnt/b/Output", "url_output":
+        #: "http://localhost:8000/b/"}}. Every volume has its own state tree
+        #: (served by its own AppServer) and output root. The volume of a job
+        #: is encoded in its ID as ".<name>" suffix, IDs without the suffix
+        #: belong to the default volume (gate_path_shared, gate_path_output)
+        #: named "". Optional "url_output" defaults to gate_url_output and
+        #: "accel_prefix" to gate_output_accel_prefix + "<name>/".
+        self.gate_volumes = {}
+        #: Assignment of new jobs to volumes: "hash" - rendezvous hashing of
+        #: the Job ID, "service" - gate_volume_services (services that are not
+        #: listed are assigned by hashing the service name)
+        self.gate_volume_assign = "hash"
+        #: Service -> name of the volume receiving its jobs ("default" applies
+        #: to services that are not listed)
+        self.gate_volume_services = {}
+        #: Names of volumes receiving new jobs assigned by hashing (all volumes
+        #: when null). Jobs on the remaining volumes stay accessible.
+        self.gate_volume_submit = None
+        #: Backend storing job states and flags: "symlink" - symbolic links
+        #: on the shared storage used by AppServer, "sqlite" - SQLite database
+        self.gate_backend = 'symlink'
+        #: Path to the SQLite database of job states (has to be on a local
+        #: file system, WAL mode does not work on network file systems)
+        self.gate_path_database = 'AppGateway.sqlite'
+        #: Mirror new jobs and flags to the shared storage and import job
+        #: states set by AppServer when the SQLite backend is used (for
+        #: AppServer using the symbolic links protocol)
+        self.gate_backend_mirror = True
+        #: Interval (in seconds) between imports of job states from the shared
+        #: storage to the SQLite database
+        self.gate_backend_sync = 5
+        #: Number of levels of hash-prefix subdirectories used to store job
+        #: entries in the jobs, opts, flags and state directories (0 - flat
+        #: layout). AppServer has to use the same layout.
+        self.gate_shard_levels = 0
+        #: Number of hexadecimal digits of the job ID hash used as a
+        #: subdirectory name on every level of the sharded layout
+        self.gate_shard_width = 2
+        #: Look for job entries also in the flat layout. Has to be enabled
+        #: while the shared storage is migrated to the sharded layout.
+        self.gate_shard_fallback = False
+        #: Keep an in-memory index of job states instead of checking the shared
+        #: storage on every request
+        self.gate_state_index = False
+        #: Use inotify to update the job state index (when pyinotify is
+        #: available)
+        self.gate_state_index_inotify = True
+        #: Interval (in seconds) between rescans of modified directories
+        self.gate_state_index_rescan = 5
+        #: Maximum number of cached results of finished jobs (0 disables the
+        #: cache)
+        self.gate_cache_size = 10000
+        #: Interval (in seconds) between checks if cached result of a finished
+        #: job is still valid
+        self.gate_cache_validate = 10
+        #: Maximum number of cached output manifests of finished jobs (0
+        #: disables the cache)
+        self.gate_manifest_cache = 1000
+        #: Let the front-end web server send output files: "x-sendfile"
+        #: (Apache mod_xsendfile, lighttpd), "x-accel-redirect" (nginx) or
+        #: "" (files are sent by AppGateway)
+        self.gate_output_offload = ""
+        #: URL prefix of the nginx internal location mapped to
+        #: gate_path_output (used with "x-accel-redirect")
+        self.gate_output_accel_prefix = "/output_internal/"
+        #: Time (in seconds) clients and proxies can cache responses for jobs
+        #: in terminal states (status, output URL, output files, final logs)
+        self.gate_http_max_age_terminal = 3600
+        #: Time (in seconds) clients and proxies can cache responses for
+        #: active jobs (status, progress log)
+        self.gate_http_max_age_active = 1
+        #: Minimal size (in bytes) of response bodies compressed with brotli
+        #: (when available) or gzip if the client accepts it (0 disables)
+        self.gate_compress_min_size = 1024
+        #: Compression level (1-9 for gzip, 0-11 for brotli)
+        self.gate_compress_level = 6
+        #: Minimal interval (in seconds) between listings of state directories
+        #: done to count jobs for metrics when the state index is not used
+        self.gate_metrics_sample = 60
+        #: Minimal interval (in seconds) between computations of job
+        #: statistics returned by /stats
+        self.gate_stats_interval = 5
+        #: Interval (in seconds) between checks of watched jobs states
+        self.gate_watch_interval = 1
+        #: Minimal number of jobs looked up at once (by /status POST requests
+        #: and the watcher) for which state directories are listed instead
+        #: of checking every job separately (when the state index is not used)
+        self.gate_lookup_batch_min = 16
+        #: Maximum time (in seconds) a long-poll watch request is held
+        self.gate_watch_timeout = 60
+        #: Maximum time (in seconds) between two messages sent on a
+        #: Server-Sent-Events stream
+        self.gate_watch_keepalive = 15
+        #: Number of threads running blocking file system operations when
+        #: AppGateway runs on the asynchronous server
+        self.gate_async_threads = 32
+        #: Maximum number of concurrent blocking operations per file system
+        #: ("shared" - shared storage, "output" - jobs output) when AppGateway
+        #: runs on the asynchronous server. Every volume gets its own limits,
+        #: "shared:<name>" and "output:<name>" override them for a volume.
+        self.gate_async_limits = {"shared": 16, "output": 16}
+        #: Run Flask in debug mode (do not enable in production)
+        self.gate_debug = False
+        #: Fraction of requests whose traces (file system operations with
+        #: their timing) are logged
+        self.gate_trace_sample = 0.0
+        #: Minimal duration (in seconds) of requests whose traces are always
+        #: logged (0 disables)
+        self.gate_trace_slow = 1.0
+        #: Interval (in seconds) between checks of the config file
+        #: modification time. Changed config is loaded and swapped in without
+        #: a restart (0 disables).
+        self.gate_config_reload = 0
+        #: Volume name -> :py:class:`Volume` (including the default volume)
+        self.volumes = {}
         self.gate_path_jobs = None
         self.gate_path_opts = None
+        self.gate_path_tmp = None
         self.gate_path_flags = None
         self.gate_path_new = None
         self.gate_path_waiting = None
@@ -95,7 +319,8 @@ class Config(dict):
     def load(self, conf_name=None):
         """
         Load CISAppGateway configuration from JSON file and finalize the
-        initialisation.
+        initialisation. Logging is not configured, application entry points
+        call :py:meth:`setup_logging`.
 
         :param conf_name: name of CISAppGateway config file. When *None* is
             provided hardcoded defaults are used.
@@ -109,7 +334,13 @@ class Config(dict):
                 _conf = self.json_load(_conf_file)
             log(VERBOSE, json.dumps(_conf))
             self.update(_conf)
+        self.finalise()
 
+    def finalise(self):
+        """
+        Normalize paths and derive the shared storage directories and volumes
+        from the loaded options.
+        """
         debug('@Config - Finalise configuration initialisation')
         # Normalize paths to full versions
         for _key, _value in self.items():
@@ -121,6 +352,7 @@ class Config(dict):
         # Generate subdir names
         self.gate_path_jobs = os.path.join(self.gate_path_shared, 'jobs')
         self.gate_path_opts = os.path.join(self.gate_path_shared, 'opts')
+        self.gate_path_tmp = os.path.join(self.gate_path_shared, 'tmp')
         self.gate_path_flags = os.path.join(self.gate_path_shared, 'flags')
         self.gate_path_new = os.path.join(self.gate_path_shared, 'new')
         self.gate_path_waiting = os.path.join(self.gate_path_shared, 'waiting')
@@ -149,9 +381,247 @@ class Config(dict):
             "aborted": self.gate_path_aborted,
             "killed": self.gate_path_killed,
         }
+        self.volumes = self.load_volumes()
 
         log(VERBOSE, self)
 
+    def setup_logging(self):
+        """
+        Apply the logging configuration (log_level, log_output). Handlers
+        installed by the WSGI container are kept. Traces are logged regardless
+        of the level.
+        """
+        global _log_handler, _logging_configured
+        _root = logging.getLogger()
+        _output = self.log_output and os.path.abspath(self.log_output)
+        if _log_handler is not None and _log_handler.baseFilename != _output:
+            _root.removeHandler(_log_handler)
+            _log_handler.close()
+            _log_handler = None
+        if _output and _log_handler is None:
+            _log_handler = logging.FileHandler(_output)
+            _log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+            _root.addHandler(_log_handler)
+        logging.basicConfig()
+        _root.setLevel(self.log_level)
+        logging.getLogger(TRACE_LOGGER).setLevel(logging.INFO)
+        _logging_configured = True
+
+    def check(self):
+        """
+        Check that directories of every shared storage volume exist.
+
+        :raise ValueError: when a directory is missing.
+        """
+        _dirs = [self.gate_path_jobs, self.gate_path_opts,
+                 self.gate_path_flag_delete, self.gate_path_flag_stop,
+                 self.gate_path_flag_old_api] + \
+            [self.gate_path[_state] for _state in self.service_states]
+        _missing = [_dir for _path in _dirs
+                    for _dir in self.volume_dirs(_path)
+                    if not os.path.isdir(_dir)]
+        _missing.extend(_volume.output for _volume in self.volumes.values()
+                        if not os.path.isdir(_volume.output))
+        if _missing:
+            raise ValueError("Missing directories: %s" % ', '.join(_missing))
+
+    def reload(self):
+        """
+        Load the config file again and swap the new configuration in. The new
+        configuration is fully initialised (paths and volumes) and checked
+        before the swap, invalid configuration is rejected and the current
+        one stays in use. Changes of :py:data:`RESTART_OPTIONS` are ignored
+        (the state index, backend and I/O pool keep using the paths and
+        volumes they were started with).
+
+        Options are replaced one by one, a request running during the swap
+        may read some options of the old and some of the new configuration.
+
+        :return: *True* if the configuration was replaced.
+        """
+        _new = Config()
+        try:
+            _new.load(self.config_file)
+            _restored = False
+            for _key in RESTART_OPTIONS:
+                if _new[_key] != self[_key]:
+                    warning("@Config - Change of %s requires a restart" %
+                            _key)
+                    _new[_key] = self[_key]
+                    _restored = True
+            if _restored:
+                # Derive directories and volumes from the current options
+                _new.finalise()
+            _new.check()
+        except:
+            error("@Config - Invalid configuration %s, keeping the current "
+                  "one" % self.config_file, exc_info=True)
+            return False
+        dict.update(self, _new)
+        # Logging is left to the application when it did not configure it
+        if _logging_configured:
+            self.setup_logging()
+        info("@Config - Reloaded configuration: %s" % self.config_file)
+        return True
+
+    def load_volumes(self):
+        """
+        Validate configuration of shared storage volumes.
+
+        :return: dict mapping volume names to :py:class:`Volume` instances.
+        """
+        _volumes = {'': Volume('', self.gate_path_shared,
+                               self.gate_path_output, self.gate_url_output,
+                               self.gate_output_accel_prefix)}
+        for _name, _volume in self.gate_volumes.items():
+            if not VOLUME_NAME_RE.match(_name):
+                raise ValueError("Invalid volume name: %s" % _name)
+            if 'shared' not in _volume or 'output' not in _volume:
+                raise ValueError("Volume %s requires shared and output paths"
+                                 % _name)
+            _volumes[_name] = Volume(
+                _name,
+                os.path.realpath(_volume['shared']),
+                os.path.realpath(_volume['output']),
+                _volume.get('url_output', self.gate_url_output),
+                _volume.get('accel_prefix',
+                            self.gate_output_accel_prefix + _name + '/'),
+            )
+        if self.gate_volume_assign not in ('hash', 'service'):
+            raise ValueError("Invalid gate_volume_assign: %s" %
+                             self.gate_volume_assign)
+        for _name in list(self.gate_volume_services.values()) + \
+                list(self.gate_volume_submit or ()):
+            if _name not in _volumes:
+                raise ValueError("Unknown volume: %s" % _name)
+        return _volumes
+
+    def volume(self, id):
+        """
+        Return :py:class:`Volume` holding entries of job id. IDs without a
+        volume suffix (or with an unknown one) belong to the default volume.
+        """
+        _head, _dot, _name = id.rpartition('.')
+        return self.volumes.get(_name if _dot else '', self.volumes[''])
+
+    def assign_volume(self, service, id):
+        """
+        Return name of the volume receiving a new job.
+
+        :param id: Job ID without the volume suffix.
+        """
+        if not self.gate_volumes:
+            return ''
+        if self.gate_volume_assign == 'service':
+            _name = self.gate_volume_services.get(
+                service, self.gate_volume_services.get('default'))
+            if _name is not None:
+                return _name
+            id = service
+        # Rendezvous hashing, adding a volume moves only the keys it wins
+        _names = self.gate_volume_submit
+        if _names is None:
+            _names = sorted(self.volumes)
+        return max(_names, key=lambda _name: hashlib.md5(
+            (_name + '/' + id).encode('utf-8')).hexdigest())
+
+    def volume_path(self, path, id):
+        """
+        Return directory of the volume holding job id corresponding to a
+        directory of the default volume (e.g. gate_path_jobs).
+        """
+        if not self.gate_volumes:
+            return path
+        _volume = self.volume(id)
+        if not _volume.name:
+            return path
+        return _volume.shared + self.relative_shared(path)
+
+    def volume_dirs(self, path):
+        """
+        Return list of directories corresponding to a directory of the
+        default volume (e.g. gate_path['done']) on every volume, the default
+        volume first.
+        """
+        if not self.gate_volumes:
+            return [path]
+        _relative = self.relative_shared(path)
+        return [path] + [self.volumes[_name].shared + _relative
+                         for _name in sorted(self.volumes) if _name]
+
+    def relative_shared(self, path):
+        """
+        Return path of a directory of the default volume relative to
+        gate_path_shared (with the leading separator).
+        """
+        if path != self.gate_path_shared and \
+                not path.startswith(self.gate_path_shared + os.sep):
+            raise ValueError("Path outside of the shared storage: %s" % path)
+        return path[len(self.gate_path_shared):]
+
+    def output_path(self, id, *names):
+        """
+        Return path of the output directory of job id (or of an entry in it).
+        """
+        return os.path.join(self.volume(id).output, id, *names)
+
+    def output_url(self, id):
+        """
+        Return URL of the output directory of job id.
+        """
+        return self.volume(id).url_output + "/" + id
+
+    def shard(self, id):
+        """
+        Return path (relative to a job directory) of the hash-prefix
+        subdirectory holding entries of job id. Empty string is returned for
+        the flat layout.
+        """
+        if not self.gate_shard_levels:
+            return ''
+        _hash = hashlib.md5(id.encode('utf-8')).hexdigest()
+        _width = self.gate_shard_width
+        return os.path.join(*[
+            _hash[_level * _width:(_level + 1) * _width]
+            for _level in range(self.gate_shard_levels)
+        ])
+
+    def job_path(self, path, id, name=None):
+        """
+        Resolve path of a job entry. All paths of per job entries on the
+        shared storage are constructed using this method.
+
+        :param path: job directory of the default volume (e.g.
+            gate_path_jobs, gate_path['done']), the corresponding directory
+            of the job's volume is used (see :py:meth:`volume_path`).
+        :param id: Job ID.
+        :param name: name of the entry (defaults to the job ID), e.g.
+            "message_<id>" in the opts directory.
+        """
+        return os.path.join(self.volume_path(path, id), self.shard(id),
+                            name or id)
+
+    def job_paths(self, path, id, name=None):
+        """
+        Return tuple of paths where a job entry may be present: the path
+        returned by :py:meth:`job_path` followed by the flat layout path when
+        gate_shard_fallback is enabled.
+        """
+        _path = self.job_path(path, id, name)
+        if self.gate_shard_levels and self.gate_shard_fallback:
+            return _path, os.path.join(self.volume_path(path, id),
+                                       name or id)
+        return _path,
+
+    def is_shard(self, name, depth):
+        """
+        Check if name found at given depth below a job directory is a
+        hash-prefix subdirectory of the sharded layout.
+        """
+        return depth < self.gate_shard_levels and \
+            len(name) == self.gate_shard_width and \
+            all(_char in '0123456789abcdef' for _char in name)
+
     def json_load(self, file):
         """
         Parse a JSON file
@@ -165,32 +635,71 @@ class Config(dict):
                 ...
                 */
 
-        Based on:
-        http://www.lifl.fr/~riquetd/parse-a-json-file-with-comments.html.
-        Much faster than https://github.com/getify/JSON.minify and
-        https://gist.github.com/WizKid/1170297
+        Comments are removed in a single pass of :py:data:`COMMENT_RE` over
+        the file (strings are copied unchanged, so "//" in URLs is kept).
+        Block comments are replaced with the newlines they contain, so line
+        numbers reported by the json module match the file.
 
         :param file: name of the file to parse.
         """
-        content = ''.join(file.readlines())
+        return json.loads(COMMENT_RE.sub(_strip_comment, file.read()))
+
+
+def _strip_comment(match):
+    if match.group(1) is not None:
+        return match.group(1)
+    return '\n' * match.group(0).count('\n')
 
-        # Regular expression for comment
-        comment_re = re.compile(
-            '(^)?[^\S\n]*/(?:\*(.*?)\*/[^\S\n]*|/[^\n]*)($)?',
-            re.DOTALL | re.MULTILINE
-        )
 
-        ## Looking for comments
-        match = comment_re.search(content)
-        while match:
-            # single line comment
-            content = content[:match.start()] + content[match.end():]
-            match = comment_re.search(content)
+class ConfigReloader(object):
+    """
+    Background thread reloading the configuration when the config file
+    changes (see :py:meth:`Config.reload`).
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.thread = None
+        #: Modification time of the loaded config file
+        self.mtime = None
+
+    def start(self):
+        """
+        Start the reload thread. Does nothing if reloads are disabled, no
+        config file was loaded or the thread was already started.
+        """
+        with self.lock:
+            if self.thread is not None or not self.config.gate_config_reload \
+                    or self.config.config_file is None:
+                return
+            self.mtime = self._mtime()
+            self.thread = threading.Thread(target=self.run,
+                                           name="ConfigReloader")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        """
+        Check loop run by the background thread.
+        """
+        while True:
+            time.sleep(self.config.gate_config_reload)
+            try:
+                _mtime = self._mtime()
+                if _mtime != self.mtime:
+                    # An invalid file is not retried until it changes again
+                    self.mtime = _mtime
+                    self.config.reload()
+            except:
+                error("@Config - Config reload failed", exc_info=True)
 
-        # Return json file
-        return json.loads(content)
+    def _mtime(self):
+        return os.stat(self.config.config_file).st_mtime
 
 
 #: Global Config class instance. Use it to access the CISAppGateway
 #: configuration.
 conf = Config()
+#: Global ConfigReloader instance
+reloader = ConfigReloader(conf)
@@ -0,0 +1,458 @@
+"""
+In-memory index of job states stored on the shared storage.
+
+The index mirrors contents of the jobs, flags and state directories used to
+communicate with CISAppServer. It is filled by a single listing of every
+monitored directory and then kept current using inotify (when pyinotify is
+available) and periodic rescans of directories whose mtime has changed.
+Rescans are always performed as inotify is not able to report changes made by
+remote hosts on network file systems. For the sharded layout (see
+:py:meth:`Config.shard`) every hash-prefix subdirectory is checked separately.
+"""
+
+import os
+import time
+import threading
+
+from logging import debug, error, info, warning
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from CISAppGateway import Storage
+from CISAppGateway.Config import conf
+
+#: Job states in the order used to resolve the state of a job present in more
+#: than one state directory (jobs are moved between the directories by
+#: AppServer)
+STATE_PRIORITY = (
+    'aborted', 'failed', 'done', 'killed', 'closing', 'cleanup', 'running',
+    'queued', 'processing', 'waiting', 'new',
+)
+#: Flags that can be set for a job
+FLAGS = ('delete', 'stop', 'old_api')
+#: States for which the time jobs entered the state is tracked
+AGE_STATES = ('new', 'waiting', 'queued')
+#: Whether inotify may be used at all (cleared by servers it does not work
+#: with, independently of gate_state_index_inotify)
+INOTIFY = True
+
+
+def job_service(id):
+    """
+    Return name of the service encoded in the job ID (IDs created by
+    :py:func:`Server.submit` start with "<service>_").
+    """
+    return id.split('_', 1)[0]
+
+
+class StateIndex(object):
+    """
+    Map of job IDs to job states and flags.
+
+    Contents of every monitored directory are stored as a set of job IDs.
+    Readers do not need to acquire the lock to test membership. Number of jobs
+    per service in every directory is updated along with the sets.
+
+    For states listed in :py:data:`AGE_STATES` the time every job entered the
+    state is recorded: ctime of the state entry for entries found by scans,
+    time of the event for entries reported by inotify.
+    """
+
+    def __init__(self):
+        #: Directory key (jobs, state or flag name) -> set of job IDs
+        self.entries = {}
+        #: Directory key -> dict mapping service name to number of jobs
+        self.counts = {}
+        #: Directory key -> dict mapping job ID to time (in whole seconds)
+        #: the job entered the directory (only for AGE_STATES)
+        self.entered = {}
+        #: Directory key -> dict mapping time (in whole seconds) to number of
+        #: jobs that entered the directory at that time (only for AGE_STATES)
+        self.entry_counts = {}
+        #: Directory path -> set of job IDs present in the directory: found by
+        #: the last scan or recorded by :py:meth:`add` since then (there is
+        #: more than one directory per key for the sharded layout)
+        self.scanned = {}
+        #: Directory path -> list of hash-prefix subdirectories
+        self.subdirs = {}
+        #: Directory path -> mtime of the directory at the time of last scan
+        self.mtimes = {}
+        self.lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.started = False
+        self.thread = None
+        self.notifier = None
+
+    def directories(self):
+        """
+        Return list of tuples (directory key, path) monitored by the index.
+        There is one path per key on every shared storage volume.
+        """
+        _dirs = {
+            'jobs': conf.gate_path_jobs,
+            'delete': conf.gate_path_flag_delete,
+            'stop': conf.gate_path_flag_stop,
+            'old_api': conf.gate_path_flag_old_api,
+        }
+        _dirs.update(conf.gate_path)
+        return [(_key, _dir) for _key, _path in _dirs.items()
+                for _dir in conf.volume_dirs(_path)]
+
+    def start(self):
+        """
+        Perform the initial scan of shared storage and start the threads that
+        keep the index up to date. Does nothing if index was already started.
+        """
+        with self.start_lock:
+            if self.started:
+                return
+            debug("@StateIndex - Initial scan of shared storage")
+            self.rescan(force=True)
+            self.start_inotify()
+            self.thread = threading.Thread(target=self.run,
+                                           name="StateIndexRescan")
+            self.thread.daemon = True
+            self.thread.start()
+            self.started = True
+
+    def start_inotify(self):
+        """
+        Register inotify watches for all monitored directories.
+        """
+        if pyinotify is None or not INOTIFY or \
+                not conf.gate_state_index_inotify:
+            info("@StateIndex - inotify not available, using rescans only")
+            return
+
+        _manager = pyinotify.WatchManager()
+        _mask = pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+            pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM
+        _keys = {}
+        for _key, _path in self.directories():
+            _wd = _manager.add_watch(_path, _mask,
+                                     rec=bool(conf.gate_shard_levels),
+                                     auto_add=bool(conf.gate_shard_levels))
+            if _wd.get(_path) is not None and _wd[_path] >= 0:
+                _keys[_path] = _key
+        self.notifier = pyinotify.ThreadedNotifier(
+            _manager, _InotifyHandler(index=self, keys=_keys))
+        self.notifier.daemon = True
+        self.notifier.start()
+
+    def run(self):
+        """
+        Rescan loop run by a background thread.
+        """
+        while True:
+            time.sleep(conf.gate_state_index_rescan)
+            try:
+                self.rescan()
+            except:
+                error("@StateIndex - Rescan failed", exc_info=True)
+
+    def rescan(self, force=False):
+        """
+        Reload contents of directories modified since the last scan.
+
+        :param force: reload all directories regardless of their mtime.
+        """
+        _now = time.time()
+        for _key, _path in self.directories():
+            _dirs = [(_path, 0)]
+            while _dirs:
+                _dir, _depth = _dirs.pop()
+                _mtime = Storage.stat(_dir).st_mtime
+                if force or self.mtimes.get(_dir) != _mtime:
+                    self._scan(_key, _path, _dir, _depth)
+                    # Directory mtime resolution can be as coarse as one
+                    # second (e.g. on NFS). Modifications done within the
+                    # same second would go unnoticed, force another scan in
+                    # such case.
+                    if _now - _mtime > 1:
+                        self.mtimes[_dir] = _mtime
+                    else:
+                        self.mtimes[_dir] = None
+                _dirs.extend((_subdir, _depth + 1)
+                             for _subdir in self.subdirs.get(_dir, ()))
+
+    def _scan(self, key, root, path, depth):
+        """
+        List a single directory and apply the differences since the last scan
+        to the entries of directory key.
+
+        :param root: path of the directory identified by key.
+        :param path: path of the scanned directory (root itself or its
+            hash-prefix subdirectory).
+        """
+        # Entries recorded before the listing started, the ones added later
+        # (e.g. by add) are kept even when the listing misses them
+        with self.lock:
+            _old = set(self.scanned.get(path, ()))
+        _entries = set()
+        _subdirs = []
+        for _name in Storage.listdir(path):
+            if conf.is_shard(_name, depth):
+                _subdirs.append(os.path.join(path, _name))
+            else:
+                _entries.add(_name)
+        _times = {}
+        if key in AGE_STATES:
+            _all = self.entries.get(key, ())
+            for _id in _entries - _old:
+                if _id not in _all:
+                    _times[_id] = self._entry_time(path, _id)
+        with self.lock:
+            _live = self.scanned.setdefault(path, set())
+            _all = self.entries.setdefault(key, set())
+            # Entries could have been already updated by add/discard
+            _added = [_id for _id in _entries if _id not in _all]
+            _gone = _old - _entries
+            _removed = [
+                _id for _id in _gone
+                if _id in _all and not self._scanned_elsewhere(root, path, _id)
+            ]
+            _all.update(_added)
+            _all.difference_update(_removed)
+            self._count(key, _added, _removed, _times)
+            _live.difference_update(_gone)
+            _live.update(_entries)
+            self.subdirs[path] = _subdirs
+
+    def _entry_time(self, path, id):
+        """
+        Return ctime of a job entry found by a scan (time of its creation or
+        of the last rename).
+        """
+        try:
+            return Storage.lstat(os.path.join(path, id)).st_ctime
+        except OSError:
+            return time.time()
+
+    def _scanned_elsewhere(self, root, path, id):
+        """
+        Check if job was found by the last scan of a directory other than
+        path. For the sharded layout a job entry can be present both in its
+        hash-prefix subdirectory and in the root directory while the shared
+        storage is migrated.
+        """
+        if not conf.gate_shard_levels:
+            return False
+        for _dir in (root, os.path.join(root, conf.shard(id))):
+            if _dir != path and id in self.scanned.get(_dir, ()):
+                return True
+        return False
+
+    def add(self, key, id):
+        """
+        Record presence of a job in the directory identified by key. The
+        entry is removed by the next scan of its directory that does not
+        find it.
+        """
+        with self.lock:
+            if key in self.entries and id not in self.entries[key]:
+                self.entries[key].add(id)
+                self._count(key, (id,), ())
+                self.scanned.setdefault(self._home(key, id), set()).add(id)
+
+    def discard(self, key, id):
+        """
+        Record removal of a job from the directory identified by key.
+        """
+        with self.lock:
+            if key in self.entries and id in self.entries[key]:
+                self.entries[key].discard(id)
+                self._count(key, (), (id,))
+                self.scanned.get(self._home(key, id), set()).discard(id)
+
+    def path(self, key):
+        """
+        Return path of the directory identified by key (on the default
+        volume, see :py:meth:`Config.job_path`).
+        """
+        if key == 'jobs':
+            return conf.gate_path_jobs
+        elif key in FLAGS:
+            return os.path.join(conf.gate_path_flags, key)
+        return conf.gate_path[key]
+
+    def _home(self, key, id):
+        """
+        Return path of the directory holding entry of job id in the directory
+        identified by key.
+        """
+        return os.path.dirname(conf.job_path(self.path(key), id))
+
+    def _count(self, key, added, removed, times=None):
+        """
+        Update number of jobs per service in directory identified by key. Has
+        to be called with the lock held.
+
+        :param times: dict mapping added job IDs to the time they entered the
+            directory (current time is used for missing IDs).
+        """
+        _counts = self.counts.setdefault(key, {})
+        for _id in added:
+            _service = job_service(_id)
+            _counts[_service] = _counts.get(_service, 0) + 1
+        for _id in removed:
+            _service = job_service(_id)
+            _counts[_service] -= 1
+            if not _counts[_service]:
+                del _counts[_service]
+        if key in AGE_STATES:
+            self._track_entry_times(key, added, removed, times or {})
+
+    def _track_entry_times(self, key, added, removed, times):
+        """
+        Update times jobs entered directory identified by key. Has to be
+        called with the lock held.
+        """
+        _entered = self.entered.setdefault(key, {})
+        _counts = self.entry_counts.setdefault(key, {})
+        _now = time.time()
+        for _id in added:
+            _time = _entered[_id] = int(times.get(_id, _now))
+            _counts[_time] = _counts.get(_time, 0) + 1
+        for _id in removed:
+            _time = _entered.pop(_id, None)
+            if _time is None:
+                continue
+            _counts[_time] -= 1
+            if not _counts[_time]:
+                del _counts[_time]
+
+    def service_counts(self, key):
+        """
+        Return dict mapping service names to number of jobs in directory
+        identified by key.
+        """
+        with self.lock:
+            return dict(self.counts.get(key, {}))
+
+    def entry_times(self, key):
+        """
+        Return list of tuples (time, number of jobs) sorted by time, listing
+        when jobs present in directory identified by key (one of
+        :py:data:`AGE_STATES`) entered it. Size of the list depends on the
+        spread of the times, not on the number of jobs.
+        """
+        with self.lock:
+            _times = list(self.entry_counts.get(key, {}).items())
+        _times.sort()
+        return _times
+
+    def entry_time(self, key, id):
+        """
+        Return time (in whole seconds) job entered directory identified by
+        key (one of :py:data:`AGE_STATES`) or *None* if it is not known.
+        """
+        return self.entered.get(key, {}).get(id)
+
+    def members(self, key):
+        """
+        Return copy of the set of job IDs present in the directory identified
+        by key. Starts the index on first use.
+        """
+        if not self.started:
+            self.start()
+        with self.lock:
+            return set(self.entries.get(key, ()))
+
+    def contains(self, key, id):
+        """
+        Check if job is present in the directory identified by key.
+
+        :return: *None* if the index was not started yet.
+        """
+        if not self.started:
+            return None
+        return id in self.entries[key]
+
+    def lookup(self, id):
+        """
+        Find state and flags of a job. Starts the index on first use.
+
+        :param id: Job ID
+        :return: tuple (state, flags) where flags is a frozenset of flag names.
+            Returns *None* if the job is not indexed.
+        """
+        if not self.started:
+            self.start()
+        if id not in self.entries['jobs']:
+            return None
+        for _state in STATE_PRIORITY:
+            if id in self.entries[_state]:
+                break
+        else:
+            # Job exists but was not yet seen in any state directory
+            return None
+        _flags = frozenset(
+            _flag for _flag in FLAGS if id in self.entries[_flag]
+        )
+        return _state, _flags
+
+
+if pyinotify is not None:
+    class _InotifyHandler(pyinotify.ProcessEvent):
+        """
+        Apply inotify events to the state index.
+        """
+
+        def my_init(self, index, keys):
+            self.index = index
+            self.keys = keys
+
+        def root(self, event):
+            """
+            Return path of the monitored directory the event happened in.
+            Events for hash-prefix subdirectories themselves are ignored
+            (*None*).
+            """
+            if event.dir:
+                return None
+            _path = event.path
+            while _path not in self.keys:
+                _parent = os.path.dirname(_path)
+                if _parent == _path:
+                    return None
+                _path = _parent
+            return _path
+
+        def process_IN_CREATE(self, event):
+            self._add(event)
+
+        def process_IN_MOVED_TO(self, event):
+            self._add(event)
+
+        def process_IN_DELETE(self, event):
+            self._discard(event)
+
+        def process_IN_MOVED_FROM(self, event):
+            self._discard(event)
+
+        def _add(self, event):
+            _root = self.root(event)
+            if _root is not None:
+                self.index.add(self.keys[_root], event.name)
+
+        def _discard(self, event):
+            _root = self.root(event)
+            if _root is None:
+                return
+            # Removal of a flat layout entry moved to its hash-prefix
+            # subdirectory during migration, left to rescans
+            if conf.gate_shard_levels and event.path != \
+                    os.path.join(_root, conf.shard(event.name)):
+                return
+            self.index.discard(self.keys[_root], event.name)
+
+        def process_IN_Q_OVERFLOW(self, event):
+            warning("@StateIndex - inotify queue overflow, full rescan")
+            self.index.rescan(force=True)
+
+
+#: Global StateIndex instance
+index = StateIndex()
@@ -0,0 +1,169 @@
+"""
+Minimal implementation of metrics exposed in the Prometheus text format.
+
+Updating a metric costs a dictionary lookup and a lock acquisition, so metrics
+can stay enabled under production load. Values that are expensive to compute
+are provided by collectors called only when metrics are rendered.
+"""
+
+import bisect
+import threading
+
+#: Default buckets (in seconds) of latency histograms
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0,
+)
+
+#: Registered metrics in the order of registration
+metrics = []
+#: Registered collectors, see :py:func:`register_collector`
+collectors = []
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (_name, _escape(_value))
+        for _name, _value in zip(names, values)
+    )
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n') \
+        .replace('"', '\\"')
+
+
+class Counter(object):
+    """
+    Monotonically increasing value, optionally split by labels.
+    """
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics.append(self)
+
+    def inc(self, labels=(), value=1):
+        """
+        Increase the counter.
+
+        :param labels: tuple of label values (in the order of label names).
+        """
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self):
+        with self.lock:
+            _values = sorted(self.values.items())
+        for _labels_values, _value in _values:
+            yield self.name + _labels(self.labels, _labels_values), _value
+
+
+class Histogram(object):
+    """
+    Distribution of observed values in fixed buckets, optionally split by
+    labels.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        #: labels -> [per bucket counts (last one is +Inf), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics.append(self)
+
+    def observe(self, value, labels=()):
+        """
+        Record an observed value.
+
+        :param labels: tuple of label values (in the order of label names).
+        """
+        _idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            _value = self.values.get(labels)
+            if _value is None:
+                _value = self.values[labels] = \
+                    [[0] * (len(self.buckets) + 1), 0.0]
+            _value[0][_idx] += 1
+            _value[1] += value
+
+    def samples(self):
+        with self.lock:
+            _values = sorted(
+                (_key, (list(_value[0]), _value[1]))
+                for _key, _value in self.values.items()
+            )
+        _names = self.labels + ('le',)
+        for _labels_values, (_counts, _sum) in _values:
+            _total = 0
+            for _bound, _count in zip(self.buckets + ('+Inf',), _counts):
+                _total += _count
+                yield self.name + '_bucket' + \
+                    _labels(_names, _labels_values + (_bound,)), _total
+            yield self.name + '_sum' + \
+                _labels(self.labels, _labels_values), _sum
+            yield self.name + '_count' + \
+                _labels(self.labels, _labels_values), _total
+
+
+class Gauge(object):
+    """
+    Current value of a quantity. Gauges are created by collectors when metrics
+    are rendered and are not registered. Collectors can also use them to
+    expose counters maintained elsewhere (type='counter').
+    """
+
+    def __init__(self, name, help, labels=(), type='gauge'):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.type = type
+        self.values = {}
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+    def samples(self):
+        for _labels_values, _value in sorted(self.values.items()):
+            yield self.name + _labels(self.labels, _labels_values), _value
+
+
+def register_collector(collector):
+    """
+    Register a function returning a list of metrics (e.g. :py:class:`Gauge`)
+    computed when metrics are rendered.
+    """
+    collectors.append(collector)
+
+
+def render():
+    """
+    Return all metrics in the Prometheus text exposition format.
+    """
+    _metrics = list(metrics)
+    for _collector in collectors:
+        _metrics.extend(_collector())
+    _lines = []
+    for _metric in _metrics:
+        _lines.append('# HELP %s %s' % (_metric.name, _metric.help))
+        _lines.append('# TYPE %s %s' % (_metric.name, _metric.type))
+        for _name, _value in _metric.samples():
+            _lines.append('%s %s' % (_name, _format(_value)))
+    _lines.append('')
+    return '\n'.join(_lines)
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
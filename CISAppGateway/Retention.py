@@ -0,0 +1,226 @@
+"""
+Retention of finished jobs.
+
+Jobs stay in the terminal state directories (and in the jobs and opts
+directories) until they are removed. When gate_retention is set a background
+thread periodically marks jobs that finished longer ago than the retention
+age of their service for removal, using the same delete flags as /delete
+(the actual removal is performed by AppServer).
+
+Sweeps are incremental: a sweep flags at most gate_retention_max jobs (the
+oldest first), at most gate_retention_rate jobs per second, and the rest is
+left for the following sweeps. Only the process holding the lock file
+(gate_retention_lock) sweeps, the others retry to take the lock before every
+sweep, so the sweeps continue when the process holding it exits.
+"""
+
+import os
+import time
+import errno
+import fcntl
+import threading
+
+from logging import debug, error, info
+
+from CISAppGateway import Metrics
+from CISAppGateway.Backend import backend, entry_stat, list_jobs
+from CISAppGateway.Config import conf
+from CISAppGateway.Index import job_service
+
+#: States of finished jobs
+RETENTION_STATES = ('aborted', 'failed', 'done', 'killed')
+#: Name of the default lock file (in gate_path_shared)
+LOCK_NAME = 'retention.lock'
+
+reclaimed_count = Metrics.Counter(
+    'appgw_retention_reclaimed_total',
+    'Number of finished jobs marked for removal by the retention sweeper.',
+    labels=('service',),
+)
+
+
+class RetentionSweeper(object):
+    """
+    Background thread marking expired jobs for removal.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        #: Job ID -> time the job entered its terminal state (kept between
+        #: sweeps, so every finished job is checked once)
+        self.finished = {}
+        #: Time of the last finished sweep
+        self.time = None
+        #: Directory name -> number of entries (at the time of last sweep)
+        self.sizes = {}
+        #: Open lock file (when this process holds the lock)
+        self.lock_file = None
+
+    def start(self):
+        """
+        Start the sweeper thread. Does nothing if retention is not configured
+        or the thread was already started.
+        """
+        with self.lock:
+            if self.thread is not None or not conf.gate_retention:
+                return
+            self.thread = threading.Thread(target=self.run,
+                                           name="RetentionSweeper")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        """
+        Sweep loop run by the background thread.
+        """
+        while True:
+            time.sleep(conf.gate_retention_interval)
+            try:
+                if self.acquire():
+                    self.sweep()
+            except:
+                error("@Retention - Sweep failed", exc_info=True)
+
+    def acquire(self):
+        """
+        Take the sweeper lock file. The lock is held until the process exits.
+
+        :return: *True* if this process holds the lock.
+        """
+        if self.lock_file is not None:
+            return True
+        _path = conf.gate_retention_lock or \
+            os.path.join(conf.gate_path_shared, LOCK_NAME)
+        _file = open(_path, 'a')
+        try:
+            fcntl.flock(_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            _file.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            debug("@Retention - Sweeper lock held by another process")
+            return False
+        info("@Retention - Acquired sweeper lock %s", _path)
+        self.lock_file = _file
+        return True
+
+    def max_age(self, service):
+        """
+        Return retention age (in seconds) of jobs of a service or *None* if
+        they are kept.
+        """
+        return conf.gate_retention.get(
+            service, conf.gate_retention.get('default'))
+
+    def sweep(self):
+        """
+        Mark expired jobs for removal.
+
+        :return: number of jobs marked for removal.
+        """
+        _now = time.time()
+        _jobs = backend().find(RETENTION_STATES)
+        # Forget jobs that were removed since the last sweep
+        for _id in list(self.finished):
+            if _id not in _jobs:
+                del self.finished[_id]
+
+        _expired = []
+        for _id, _job in _jobs.items():
+            if _job.flag('delete'):
+                continue
+            _max_age = self.max_age(job_service(_id))
+            if _max_age is None:
+                continue
+            _finished = self.finished.get(_id)
+            if _finished is None:
+                _stat = entry_stat(conf.gate_path[_job.state()], _id)
+                if _stat is None:
+                    continue
+                # Renaming the state entry updates its ctime
+                _finished = self.finished[_id] = _stat.st_ctime
+            if _now - _finished >= _max_age:
+                _expired.append((_finished, _id))
+        _expired.sort()
+        del _expired[conf.gate_retention_max:]
+        debug("@Retention - %d expired jobs out of %d finished",
+              len(_expired), len(_jobs))
+
+        _flagged = self._flag([_id for _, _id in _expired])
+        self.sizes = self._sizes(_jobs)
+        self.time = time.time()
+        if _flagged:
+            info("@Retention - Marked %d jobs for removal", _flagged)
+        return _flagged
+
+    def _flag(self, ids):
+        _flagged = 0
+        _batch = max(1, min(conf.gate_bulk_batch,
+                            int(conf.gate_retention_rate) or 1))
+        for _idx in range(0, len(ids), _batch):
+            _ids = ids[_idx:_idx + _batch]
+            _start = time.time()
+            try:
+                _failed = set(backend().set_flag('delete', _ids))
+            except:
+                error("@Retention - Unable to mark jobs for removal",
+                      exc_info=True)
+                break
+            # Jobs whose flag could not be set are retried by the next sweep
+            for _id in _ids:
+                if _id in _failed:
+                    continue
+                self.finished.pop(_id, None)
+                reclaimed_count.inc((job_service(_id),))
+                _flagged += 1
+            # Keep the rate of removals requested from AppServer
+            if conf.gate_retention_rate > 0:
+                time.sleep(max(0.0, len(_ids) / float(conf.gate_retention_rate)
+                               - (time.time() - _start)))
+        return _flagged
+
+    def _sizes(self, jobs):
+        _sizes = dict((_state, 0) for _state in RETENTION_STATES)
+        for _job in jobs.values():
+            _sizes[_job.state()] += 1
+        for _name, _path in (('jobs', conf.gate_path_jobs),
+                             ('opts', conf.gate_path_opts),
+                             ('flags/delete', conf.gate_path_flag_delete)):
+            _sizes[_name] = len(list_jobs(_path))
+        return _sizes
+
+    def stats(self):
+        """
+        Return sweeper statistics: time of the last sweep, number of jobs
+        marked for removal per service and number of entries in the jobs,
+        opts, delete flag and terminal state directories.
+        """
+        with reclaimed_count.lock:
+            _reclaimed = dict(
+                (_labels[0], _count)
+                for _labels, _count in reclaimed_count.values.items()
+            )
+        return {
+            'last_sweep': self.time,
+            'reclaimed': _reclaimed,
+            'directories': dict(self.sizes),
+        }
+
+
+def _collect_metrics():
+    """
+    Metrics collector exposing directory sizes seen by the last sweep.
+    """
+    _sizes = Metrics.Gauge(
+        'appgw_retention_directory_entries',
+        'Number of entries in shared storage directories (last sweep).',
+        labels=('directory',))
+    for _name, _size in sweeper.sizes.items():
+        _sizes.set(_size, (_name,))
+    return [_sizes]
+
+
+#: Global RetentionSweeper instance
+sweeper = RetentionSweeper()
+Metrics.register_collector(_collect_metrics)
@@ -4,10 +4,12 @@ using shared file system.
 """
 
 import os
-import tempfile
+import time
+import errno
 import uuid
+import hashlib
 import stat
-import logging
+import threading
 
 try:
     import json
@@ -17,12 +19,93 @@ except:
 from logging import debug, error, warning
 from string import capitalize
 
+from CISAppGateway import Storage, Metrics
+from CISAppGateway.Admission import admission
+from CISAppGateway.Backend import backend, read_entry, StoredJob
+from CISAppGateway.Cache import LRUCache
+from CISAppGateway.Index import index, job_service, AGE_STATES
+from CISAppGateway.Retention import sweeper
+from CISAppGateway.Trace import Lazy
 from CISAppGateway.Config import conf
 
-logging.basicConfig(level=logging.DEBUG)
+#: Job states reported to clients that use deprecated API
+OLD_API_STATES = {
+    'closing': 'running',
+    'cleanup': 'running',
+    'processing': 'waiting',
+    'new': 'waiting',
+}
+#: States in which job stays until it is removed
+TERMINAL_STATES = ('aborted', 'failed', 'done', 'killed')
 
 
-def submit(request):
+class TerminalResult(object):
+    """
+    Cached result of a job in a terminal state.
+    """
+    __slots__ = ('state', 'message', 'mtime', 'validated')
+
+    def __init__(self, state, message, mtime):
+        self.state = state
+        #: Job exit message
+        self.message = message
+        #: mtime of the job exit message file
+        self.mtime = mtime
+        #: Time of the last validation of the result
+        self.validated = time.time()
+
+
+#: States in which job can be killed
+KILL_STATES = ('new', 'waiting', 'queued', 'running')
+#: Flags set by bulk actions
+BULK_FLAGS = {'kill': 'stop', 'delete': 'delete'}
+#: Errors reported by bulk actions when the flag can not be set
+BULK_ERRORS = {'kill': "Error: Unable to mark job %s for a kill",
+               'delete': "Error: Unable to mark job %s for removal"}
+#: Cache of results of jobs in terminal states
+terminal_cache = LRUCache(lambda: conf.gate_cache_size)
+
+
+def cached_result(id):
+    """
+    Return cached result of a job in terminal state. The result is dropped
+    when the job is marked for removal or its exit message file changes. The
+    shared storage is checked at most once per gate_cache_validate seconds,
+    the removal mark is checked on every call when the state index is used
+    with the symlink backend.
+
+    :return: :py:class:`TerminalResult` or *None* if the job is not cached.
+    """
+    _result = terminal_cache.get(id)
+    if _result is None:
+        return None
+
+    _validate = time.time() - _result.validated >= conf.gate_cache_validate
+    if backend().deleted(id, _validate):
+        terminal_cache.pop(id)
+        return None
+
+    if _validate:
+        try:
+            _mtime = read_entry(conf.gate_path_opts, id, "message_" + id,
+                                Storage.stat).st_mtime
+        except OSError:
+            _mtime = None
+        if _mtime != _result.mtime:
+            terminal_cache.pop(id)
+            return None
+        _result.validated = time.time()
+    return _result
+
+
+#: Job IDs and request fingerprints of submissions with idempotency keys
+idempotency_cache = LRUCache(lambda: conf.gate_idempotency_cache)
+#: Locks serializing submissions with the same idempotency key (selected by
+#: the key hash)
+_idempotency_locks = [threading.Lock() for _ in range(64)]
+
+
+def submit(request, key=None):
     """
     Submit a job request to the processing queue.
 
@@ -32,57 +115,432 @@ def submit(request):
     :param request: dict with requests' attributes. A "service" attribute with
         valid value is required.  Other atributes will be passed to the
         execution script and input files by AppServer after validation.
+    :param key: optional idempotency key. Repeated submission of the same
+        request with the same key returns ID of the already created job (as
+        long as the key is kept in the bounded cache of this process).
     :return: Job ID
     """
-    debug('Request %s' % json.dumps(request))
+    debug('Request %s', Lazy(json.dumps, request))
+    _error = validate(request)
+    if _error is not None:
+        return _error
+    debug("Service selected: %s", request['service'])
+
+    if key is None or conf.gate_idempotency_cache <= 0:
+        return _submit(request)
+
+    _fingerprint = hashlib.sha1(
+        json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+    with _idempotency_locks[hash(key) % len(_idempotency_locks)]:
+        _record = idempotency_cache.get(key)
+        if _record is not None:
+            if _record[1] != _fingerprint:
+                debug('Error: Idempotency key reused for a different request')
+                return 'Error: Idempotency key reused for a different request'
+            debug("Repeated submission, return request id: %s", _record[0])
+            return _record[0]
+        _jid = _submit(request)
+        if not _jid.startswith('Error'):
+            idempotency_cache.put(key, (_jid, _fingerprint))
+    return _jid
+
+
+def _submit(request):
+    """
+    Create job for a validated request.
+
+    :return: Job ID or Error string.
+    """
+    try:
+        _jid = create_job(request)
+    except Exception as e:
+        error("Error: Exception cought while creating job request: %s" % e)
+        return "Error: Exception cought while creating job request: %s" % e
+
+    debug("Return request id: %s", _jid)
+    return _jid
+
+
+def submit_stream(service, api, stream, key=None):
+    """
+    Submit a job request streaming its attributes into the job file.
+
+    Service and API version are validated before the payload is read. The
+    payload has to be a JSON object with the remaining request attributes.
+    It is copied to the job file in blocks and the complete job file is
+    parsed once before it is published, so invalid payload is rejected
+    (AppServer validates the job request attributes). Service and API version
+    are appended after the payload attributes (and take precedence over
+    them).
+
+    :param service: name of the service.
+    :param api: API version used by the request.
+    :param stream: file-like object with the payload.
+    :param key: optional idempotency key (see :py:func:`submit`).
+    :return: Job ID or Error string.
+    """
+    _request = {'service': service, 'api': api}
+    debug('Streamed request %s', Lazy(json.dumps, _request))
+    _error = validate(_request)
+    if _error is not None:
+        return _error
+    _request['api'] = float(api)
+
+    if conf.gate_idempotency_cache <= 0:
+        key = None
+    return _stream_job(_request, stream, key)
+
+
+def submit_max_size(service):
+    """
+    Return maximum size (in bytes) of a streamed job request for a service.
+    """
+    return conf.gate_submit_max_size.get(
+        service, conf.gate_submit_max_size['default'])
+
+
+def _stream_job(request, stream, key=None):
+    """
+    Create job for a streamed request. With an idempotency key the payload
+    is always read to compare its fingerprint with the previous submission.
+    The payload is received without holding the idempotency lock, the lock
+    is held only to check the cache and publish the job file.
+
+    :return: Job ID or Error string.
+    """
+    _jid = new_job_id(request['service'])
+    _fs = Storage.volume_filesystem(Storage.SHARED, conf.volume(_jid).name)
+    _fingerprint = hashlib.sha1(
+        json.dumps(request, sort_keys=True).encode('utf-8'))
+    try:
+        _tmp, _file = Storage.offload(_fs, _open_job_file, _jid)
+    except Exception as e:
+        error("Error: Exception cought while creating job request: %s" % e)
+        return "Error: Exception cought while creating job request: %s" % e
+
+    try:
+        _error = _copy_payload(request, stream, _file, _fingerprint, _fs)
+        if _error is None and \
+                not Storage.offload(_fs, _check_job_file, _tmp, _file):
+            _error = 'Error: Invalid request'
+        if _error is not None:
+            debug(_error)
+            Storage.offload(_fs, _discard_job_file, _tmp, _file)
+            return _error
+        if key is None:
+            return _publish_stream_job(request, _jid, _tmp, _file, _fs)
+        with _idempotency_locks[hash(key) % len(_idempotency_locks)]:
+            _record = idempotency_cache.get(key)
+            if _record is None:
+                _publish_stream_job(request, _jid, _tmp, _file, _fs)
+                idempotency_cache.put(key, (_jid, _fingerprint.hexdigest()))
+                return _jid
+            Storage.offload(_fs, _discard_job_file, _tmp, _file)
+        if _record[1] != _fingerprint.hexdigest():
+            debug('Error: Idempotency key reused for a different request')
+            return 'Error: Idempotency key reused for a different request'
+        debug("Repeated submission, return request id: %s", _record[0])
+        return _record[0]
+    except Exception as e:
+        if not _file.closed:
+            Storage.offload(_fs, _discard_job_file, _tmp, _file)
+        error("Error: Exception cought while creating job request: %s" % e)
+        return "Error: Exception cought while creating job request: %s" % e
+
+
+def _publish_stream_job(request, jid, tmp, file, fs):
+    """
+    Publish the job file of a streamed request and queue the job.
+
+    :return: Job ID
+    """
+    _name = Storage.offload(fs, _publish_job_file, jid, tmp, file)
+    debug("Job request data written to Job ID file")
+    queue_job(jid, _name, request['api'])
+    debug("Return request id: %s", jid)
+    return jid
+
+
+def _copy_payload(request, stream, file, fingerprint, fs,
+                  block_size=65536):
+    """
+    Copy JSON object from stream to the job file adding request attributes
+    after the payload attributes. Trailing whitespace and the closing brace
+    of the payload are held back until the end of the stream.
+
+    :param fs: key of the file system holding the job file.
+    :return: Error string or *None* on success.
+    """
+    _limit = submit_max_size(request['service'])
+    _size = 0
+    _started = False
+    _members = False
+    _pending = b''
+    while True:
+        _chunk = stream.read(block_size)
+        if not _chunk:
+            break
+        _size += len(_chunk)
+        if _size > _limit:
+            return 'Error: Request too large (limit: %d bytes)' % _limit
+        fingerprint.update(_chunk)
+        if not _started:
+            _chunk = _chunk.lstrip()
+            if not _chunk:
+                continue
+            if _chunk[:1] != b'{':
+                return 'Error: Invalid request'
+            Storage.offload(fs, file.write, b'{')
+            _chunk = _chunk[1:]
+            _started = True
+        _data = _pending + _chunk
+        _body = _data.rstrip()
+        if _body.endswith(b'}'):
+            _body = _body[:-1]
+        _pending = _data[len(_body):]
+        if _body:
+            _members = _members or bool(_body.strip())
+            Storage.offload(fs, file.write, _body)
+    if not _started or _pending.strip() != b'}':
+        return 'Error: Invalid request'
+    _tail = json.dumps(request)[1:].encode('utf-8')
+    if _members:
+        _tail = b', ' + _tail
+    Storage.offload(fs, file.write, _tail)
+    return None
+
+
+def _check_job_file(tmp, file):
+    """
+    Check that the written job file holds a single JSON object. The file is
+    parsed once after the upload finished (its size is limited by
+    gate_submit_max_size).
+
+    :return: *True* if the job file is valid.
+    """
+    file.flush()
+    with open(tmp, 'rb') as _file:
+        try:
+            return isinstance(json.load(_file), dict)
+        except ValueError:
+            return False
+
+
+def submit_batch(requests):
+    """
+    Submit many job requests to the processing queue at once.
+
+    All requests are validated before any job is created.
+
+    :param requests: list of dicts with requests' attributes as accepted by
+        :py:func:`submit`.
+    :return: list with Job ID or Error string for every request (in the same
+        order as requests).
+    """
+    debug('@submit_batch - Batch of %d requests', len(requests))
+    _result = [validate(_request) for _request in requests]
+    for _idx, _request in enumerate(requests):
+        if _result[_idx] is not None:
+            continue
+        try:
+            _result[_idx] = create_job(_request)
+        except Exception as e:
+            error("Error: Exception cought while creating job request: %s" %
+                  e)
+            _result[_idx] = \
+                "Error: Exception cought while creating job request: %s" % e
+    return _result
+
+
+def validate(request):
+    """
+    Check if job request can be accepted.
+
+    :param request: dict with requests' attributes.
+    :return: Error string or *None* if request is valid.
+    """
+    if not isinstance(request, dict):
+        debug('Error: Invalid request')
+        return 'Error: Invalid request'
+
     # Request is required to define service keyword
     if 'service' not in request.keys():
         debug('Error: Missing service name')
         return 'Error: Missing service name'
-    debug('Service defined: %s' % request['service'])
 
     # Only request for supported services are processed
     if request['service'] not in conf.allowed_services:
-        debug('Error: Missing service name')
+        debug('Error: Unsupported service')
         return 'Error: Unsupported service'
-    debug("Service selected: %s" % request['service'])
 
+    # API version is required to handle deprecated API requests
     try:
-        # Create file to store the input data
-        # The file name is unique and will be used as request ID
-        # Add UUID into the mix to allow for more then ~250k concurent ids
-        _prefix = request['service'] + '_' + str(uuid.uuid4()) + '_'
-        (_fd, _name) = tempfile.mkstemp(prefix=_prefix, dir=conf.gate_path_jobs)
-        _jid = os.path.basename(_name)
-        _f = os.fdopen(_fd, 'w')
-        debug("Job ID file created")
-        # Dump input data in JSON format (handle utf8 characters)
-        _f.write(json.dumps(request, ensure_ascii=False).encode('utf-8'))
-        _f.close()
-        # Workaround until webserver an jobmanager run as same user
-        _st = os.stat(_name)
-        os.chmod(_name, _st.st_mode | stat.S_IRGRP | stat.S_IWGRP |
-                 stat.S_IROTH | stat.S_IWOTH)
-        debug("Job request data written to Job ID file")
-        # Mark request as queued
-        os.symlink(
-            _name,
-            os.path.join(conf.gate_path_new, _jid)
-        )
-        # Mark deprecated API calls
-        if float(request["api"]) < conf.service_api:
-            debug("Job request uses deprecated API")
-            _path = os.path.join(conf.gate_path_flag_old_api, _jid)
-            os.symlink( _name, _path )
+        float(request['api'])
+    except (KeyError, TypeError, ValueError):
+        debug('Error: Missing or invalid API version')
+        return 'Error: Missing or invalid API version'
+
+    return None
 
-    except Exception as e:
-        error("Error: Exception cought while creating job request: %s" % e)
-        return "Error: Exception cought while creating job request: %s" % e
 
-    debug("Return request id: %s" % _jid)
+def create_job(request):
+    """
+    Create job file for a validated request and add the job to the queue.
+
+    :param request: dict with requests' attributes.
+    :return: Job ID
+    """
+    _jid = new_job_id(request['service'])
+    # Dump input data in JSON format (handle utf8 characters)
+    _data = json.dumps(request, ensure_ascii=False).encode('utf-8')
+    _name = Storage.offload(
+        Storage.volume_filesystem(Storage.SHARED, conf.volume(_jid).name),
+        _write_job_file, _jid, _data)
+    debug("Job request data written to Job ID file")
+    return queue_job(_jid, _name, request['api'])
+
+
+def new_job_id(service):
+    """
+    Return new unique Job ID for a service.
+    """
+    # The ID is used as job file name
+    # Add UUID into the mix to allow for more then ~250k concurent ids
+    _jid = service + '_' + str(uuid.uuid4()) + '_' + uuid.uuid4().hex[:8]
+    # The volume is encoded in the ID, so the job stays on its volume
+    # regardless of later changes of the assignment
+    _volume = conf.assign_volume(service, _jid)
+    if _volume:
+        _jid += '.' + _volume
     return _jid
 
 
+def queue_job(jid, name, api):
+    """
+    Add job with already published job file to the queue.
+
+    :param name: path to the job file.
+    :param api: API version used by the request.
+    :return: Job ID
+    """
+    # Mark deprecated API calls. Has to be done before the job is queued.
+    _flags = ()
+    if float(api) < conf.service_api:
+        debug("Job request uses deprecated API")
+        _flags = ('old_api',)
+    # Mark request as queued
+    backend().create(jid, name, _flags)
+    admission.job_submitted(job_service(jid))
+    return jid
+
+
+def _write_job_file(jid, data):
+    """
+    Write job request data into a new job file.
+
+    :return: Path to the job file
+    """
+    _tmp, _f = _open_job_file(jid)
+    try:
+        _f.write(data)
+    except:
+        _discard_job_file(_tmp, _f)
+        raise
+    return _publish_job_file(jid, _tmp, _f)
+
+
+def _open_job_file(jid):
+    """
+    Create temporary file for job request data. Job files are written under
+    temporary names and published with a single rename (see
+    :py:func:`_publish_job_file`), so AppServer never sees a partially
+    written job file.
+
+    :return: tuple (temporary file path, file open for writing)
+    """
+    # Has to be on the same volume as the jobs directory
+    _tmp = os.path.join(conf.volume_path(conf.gate_path_tmp, jid), jid)
+    _flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+    try:
+        _fd = os.open(_tmp, _flags, JOB_FILE_MODE)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        _make_parent(_tmp)
+        _fd = os.open(_tmp, _flags, JOB_FILE_MODE)
+    try:
+        # Workaround until webserver an jobmanager run as same user. Mode set
+        # at creation time is limited by umask.
+        if JOB_FILE_MODE & _umask:
+            os.fchmod(_fd, JOB_FILE_MODE)
+        return _tmp, os.fdopen(_fd, 'wb')
+    except:
+        os.close(_fd)
+        os.unlink(_tmp)
+        raise
+
+
+def _publish_job_file(jid, tmp, file):
+    """
+    Close temporary job file and move it to the jobs directory.
+
+    :return: Path to the job file
+    """
+    _name = conf.job_path(conf.gate_path_jobs, jid)
+    try:
+        try:
+            if conf.gate_submit_fsync:
+                file.flush()
+                os.fsync(file.fileno())
+        finally:
+            file.close()
+        try:
+            os.rename(tmp, _name)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            _make_parent(_name)
+            os.rename(tmp, _name)
+    except:
+        os.unlink(tmp)
+        raise
+    return _name
+
+
+def _discard_job_file(tmp, file):
+    """
+    Close and remove temporary job file.
+    """
+    try:
+        file.close()
+    finally:
+        os.unlink(tmp)
+
+
+def _make_parent(path):
+    """
+    Create missing parent directory of path (e.g. hash-prefix subdirectory).
+    """
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _get_umask():
+    _umask = os.umask(0)
+    os.umask(_umask)
+    return _umask
+
+
+#: Permissions of job files
+JOB_FILE_MODE = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP | \
+    stat.S_IROTH | stat.S_IWOTH
+#: Process umask (it can be read only by setting it, do it once)
+_umask = _get_umask()
+
+
 def status(id):
     """
     Check the status of a job.
@@ -93,74 +551,169 @@ def status(id):
         Aborted states additional info is provided after ":".
         Returns Error string if id does not exist.
     """
+    return status_info(id).status
+
+
+class StatusInfo(object):
+    """
+    Status of a job along with data used to validate cached copies of it.
+    """
+    __slots__ = ('status', 'state', 'mtime', 'error')
+
+    def __init__(self, status, state=None, mtime=None, error=None):
+        #: Status as returned by :py:func:`status`
+        self.status = status
+        #: Job state (*None* if status is an error)
+        self.state = state
+        #: Time the job entered the state (*None* if not known)
+        self.mtime = mtime
+        #: Error code ("not_found", "unavailable") if status is an error
+        self.error = error
+
+    @property
+    def terminal(self):
+        return self.state in TERMINAL_STATES
+
+    @property
+    def etag(self):
+        _status = self.status
+        if not isinstance(_status, bytes):
+            _status = _status.encode('utf-8')
+        return hashlib.md5(_status).hexdigest()
+
+
+def status_info(id):
+    """
+    Check the status of a job. For jobs in terminal states the modification
+    time of the exit message is used as the state change time. For other
+    states the time is taken from the state index (only tracked for
+    :py:data:`Index.AGE_STATES`) and left unknown otherwise, shared storage is
+    not checked for active jobs.
+
+    :return: :py:class:`StatusInfo`
+    """
+    debug("@status - Status check for job: %s", id)
+    _result = cached_result(id)
+    if _result is not None:
+        return StatusInfo(_result.message, _result.state, _result.mtime)
+    _info = _job_status(backend().job(id))
+    if _info.state in AGE_STATES and _info.mtime is None and index.started:
+        _info.mtime = index.entry_time(_info.state, id)
+    return _info
+
+
+def status_many(ids):
+    """
+    Check the status of many jobs at once.
+
+    Jobs are looked up by the backend at once (see
+    :py:meth:`SymlinkBackend.jobs`).
+
+    :param ids: list of job ids to check
+    :return: dict mapping job id to job status as returned by
+        :py:func:`status`.
+    """
+    return dict(
+        (_id, _info.status) for _id, _info in status_info_many(ids).items()
+    )
+
+
+def status_info_many(ids):
+    """
+    Check the status of many jobs at once (see :py:func:`status_many`).
+
+    :return: dict mapping job id to :py:class:`StatusInfo` (time the job
+        entered its state is set only for terminal states).
+    """
+    debug("@status_many - Status check for %d jobs", len(ids))
+    _result = {}
+    _pending = set()
+    for _id in set(ids):
+        _cached = cached_result(_id)
+        if _cached is not None:
+            _result[_id] = StatusInfo(_cached.message, _cached.state,
+                                      _cached.mtime)
+        else:
+            _pending.add(_id)
+
+    if not _pending:
+        return _result
+
+    try:
+        _jobs = backend().jobs(_pending)
+    except:
+        error("@status_many - Unable to check job status", exc_info=True)
+        for _id in _pending:
+            _result[_id] = StatusInfo("Error: Unable to check job status",
+                                      error='unavailable')
+        return _result
+
+    for _id in _pending:
+        if _id in _jobs:
+            _result[_id] = _job_status(_jobs[_id])
+        else:
+            warning("@status_many - Job ID not found")
+            _result[_id] = StatusInfo(
+                "Error: Job with ID:%s not found" % _id, error='not_found')
+    return _result
+
+
+def _job_status(job):
+    """
+    Return status of a job as :py:class:`StatusInfo` (modification time is
+    set only for terminal states).
+    """
     # Check if the job exists (file with it's id should be present in jobs
     # subdir)
-    debug("@status - Status check for job: %s" % id)
-    if not os.path.isfile(os.path.join(conf.gate_path_jobs, id)):
+    if not job.exists():
         warning("@status - Job ID not found")
-        return "Error: Job with ID:%s not found" % id
+        return StatusInfo("Error: Job with ID:%s not found" % job.id,
+                          error='not_found')
 
     try:
         # Check if the job requested deprecated API
-        _old_api = False
-        if os.path.exists(os.path.join(conf.gate_path_flag_old_api, id)):
-            _old_api = True
+        _old_api = job.flag('old_api')
         # Hide jobs scheduled for removal
-        if os.path.exists(os.path.join(conf.gate_path_flag_delete, id)):
+        if job.flag('delete'):
             debug("Job marked for removal")
-            return "Error: Job with ID:%s not found" % id
+            return StatusInfo("Error: Job with ID:%s not found" % job.id,
+                              error='not_found')
         # Handle remaining states
-        elif os.path.exists(os.path.join(conf.gate_path_aborted, id)):
-            _state = 'aborted'
-        elif os.path.exists(os.path.join(conf.gate_path_failed, id)):
-            _state = 'failed'
-        elif os.path.exists(os.path.join(conf.gate_path_done, id)):
-            _state = 'done'
-        elif os.path.exists(os.path.join(conf.gate_path_killed, id)):
-            _state = 'killed'
-        elif os.path.exists(os.path.join(conf.gate_path_closing, id)):
-            if _old_api:
-                _state = 'running'
-            else:
-                _state = 'closing'
-        elif os.path.exists(os.path.join(conf.gate_path_cleanup, id)):
-            if _old_api:
-                _state = 'running'
-            else:
-                _state = 'cleanup'
-        elif os.path.exists(os.path.join(conf.gate_path_running, id)):
-            _state = 'running'
-        elif os.path.exists(os.path.join(conf.gate_path_queued, id)):
-            _state = 'queued'
-        elif os.path.exists(os.path.join(conf.gate_path_processing, id)):
-            if _old_api:
-                _state = 'waiting'
-            else:
-                _state = 'processing'
-        elif os.path.exists(os.path.join(conf.gate_path_waiting, id)):
-            _state = 'waiting'
-        elif os.path.exists(os.path.join(conf.gate_path_new, id)):
-            if _old_api:
-                _state = 'waiting'
-            else:
-                _state = 'new'
-        else:
+        _state = job.state()
+        if _state is None:
             error("@status - Job status missing")
-            return "Error: Job with ID:%s not found" % id
+            return StatusInfo("Error: Job with ID:%s not found" % job.id,
+                              error='not_found')
     except:
         error("@status - Unable to check job status", exc_info=True)
-        return "Error: Unable to check job status"
+        return StatusInfo("Error: Unable to check job status",
+                          error='unavailable')
 
-    if _state in ('aborted', 'failed', 'done', 'killed'):
+    if _state in TERMINAL_STATES:
         try:
-            with open(os.path.join(conf.gate_path_opts, "message_" + id)) as _status_file:
-                return "".join(_status_file.readlines()).strip()
-        except:
+            _message, _stat = read_entry(
+                conf.gate_path_opts, job.id, "message_" + job.id,
+                Storage.read_file_stat
+            )
+            _message = _message.strip()
+            terminal_cache.put(
+                job.id, TerminalResult(_state, _message, _stat.st_mtime))
+            return StatusInfo(_message, _state, _stat.st_mtime)
+        except Exception as e:
+            # Stale state index entry of a job removed by AppServer
+            if getattr(e, 'errno', None) == errno.ENOENT and \
+                    backend().forget(job.id):
+                debug("Job %s removed since the last index update", job.id)
+                return _job_status(StoredJob(job.id))
             error("@status - Unable to read job exit code", exc_info=True)
-            return "Error: Unable to extract job exit code"
+            return StatusInfo("Error: Unable to extract job exit code",
+                              error='unavailable')
     else:
-        debug("Job %s" % _state)
-        return capitalize(_state)
+        debug("Job %s", _state)
+        if _old_api:
+            return StatusInfo(
+                capitalize(OLD_API_STATES.get(_state, _state)), _state)
+        return StatusInfo(capitalize(_state), _state)
 
 
 def output(id):
@@ -170,23 +723,138 @@ def output(id):
     :return: URL. Returns Error string if id does not exist or job is not
         finished.
     """
+    debug('@output - Output URL request')
+    _error = output_error(id)
+    if _error is not None:
+        return _error
+    return conf.output_url(id)
+
+
+def output_error(id):
+    """
+    Check if output of job identified by id is available.
+
+    :return: Error string or *None* if the job finished.
+    """
     # Check if the job exists (file with it's id should be present in jobs
     # subdir)
-    debug('@output - Output URL request')
-    if not os.path.isfile(os.path.join(conf.gate_path_jobs, id)):
+    _result = cached_result(id)
+    if _result is not None:
+        if _result.state == 'killed':
+            return "Error: Job with ID:%s did not finish." % id
+        return None
+
+    _job = backend().job(id)
+    if not _job.exists():
         warning("@output - Job ID not found")
         return "Error: Job with ID:%s not found" % id
 
-    if os.path.exists(os.path.join(conf.gate_path_flag_delete, id)):
+    if _job.flag('delete'):
         debug("@output - Job marked for removal")
         return "Error: Job with ID:%s not found" % id
 
-    if not os.path.exists(os.path.join(conf.gate_path_done, id)) and \
-       not os.path.exists(os.path.join(conf.gate_path_aborted, id)) and \
-       not os.path.exists(os.path.join(conf.gate_path_failed, id)):
+    if _job.state(('done', 'aborted', 'failed')) is None:
         return "Error: Job with ID:%s did not finish." % id
 
-    return conf.gate_url_output + "/" + id
+    return None
+
+
+class OutputManifest(object):
+    """
+    List of output files of a finished job.
+    """
+    __slots__ = ('files', 'json', 'etag', 'validated')
+
+    def __init__(self, id, files):
+        """
+        :param files: dict mapping file paths (relative to the job output
+            directory) to tuples (size, mtime).
+        """
+        self.files = files
+        #: Manifest in the format returned by /output/<id>/files
+        self.json = json.dumps({
+            'id': id,
+            'url': conf.output_url(id),
+            'files': [
+                {'name': _name, 'size': _size, 'mtime': _mtime}
+                for _name, (_size, _mtime) in sorted(files.items())
+            ],
+        })
+        self.etag = hashlib.md5(self.json.encode('utf-8')).hexdigest()
+        #: Time of the last check that the job output is still available
+        self.validated = time.time()
+
+
+#: Cache of output manifests of finished jobs
+manifest_cache = LRUCache(lambda: conf.gate_manifest_cache)
+
+
+def output_manifest(id):
+    """
+    Return manifest of output files of job identified by id. Manifests are
+    cached, availability of the output is checked again at most once per
+    gate_cache_validate seconds.
+
+    :return: :py:class:`OutputManifest`. Returns Error string if id does not
+        exist or job is not finished.
+    """
+    _manifest = manifest_cache.get(id)
+    if _manifest is not None and \
+            time.time() - _manifest.validated < conf.gate_cache_validate:
+        return _manifest
+
+    _error = output_error(id)
+    if _error is not None:
+        manifest_cache.pop(id)
+        return _error
+    if _manifest is None:
+        debug('@output - Scan output directory of job %s', id)
+        _path = conf.output_path(id)
+        _manifest = OutputManifest(id, Storage.offload(
+            Storage.filesystem(_path), _scan_output, _path
+        ))
+        manifest_cache.put(id, _manifest)
+    else:
+        _manifest.validated = time.time()
+    return _manifest
+
+
+def _scan_output(path):
+    """
+    Return dict mapping paths of regular files found in output directory
+    (relative to it) to tuples (size, mtime).
+    """
+    _files = {}
+    for _dir, _, _names in os.walk(path):
+        for _name in _names:
+            _path = os.path.join(_dir, _name)
+            try:
+                _stat = os.lstat(_path)
+            except OSError:
+                continue
+            # Symbolic links could point outside of the output directory
+            if stat.S_ISREG(_stat.st_mode):
+                _relative = os.path.relpath(_path, path).replace(os.sep, '/')
+                _files[_relative] = (_stat.st_size, _stat.st_mtime)
+    return _files
+
+
+def output_file(id, path):
+    """
+    Return location of an output file of job identified by id. Only files
+    listed in the job output manifest are available.
+
+    :param path: path of the file relative to the job output directory.
+    :return: Path to the file. Returns Error string if id does not exist, job
+        is not finished or the file does not exist.
+    """
+    _manifest = output_manifest(id)
+    if not isinstance(_manifest, OutputManifest):
+        return _manifest
+    if path not in _manifest.files:
+        return "Error: File %s not found in output of job with ID:%s" % \
+            (path, id)
+    return conf.output_path(id, *path.split('/'))
 
 
 def progress(id):
@@ -197,33 +865,150 @@ def progress(id):
     :return: Contents of progress.log file. Returns Error string if id does not
         exist.
     """
+    _log = progress_log(id)
+    if isinstance(_log, LogChunk):
+        return ''.join(_log)
+    return _log
+
+
+def progress_log(id, offset=0, end=None, tail=None):
+    """
+    Return part of the progress.log file (or output.log file for finished
+    jobs that did not generate progress.log) as a :py:class:`LogChunk`. The
+    log is not read into memory, the chunk streams its contents when iterated
+    over.
+
+    :param id: Job ID
+    :param offset: position of the first byte to return. Negative values
+        count from the end of the file.
+    :param end: position after the last byte to return (*None* for the end
+        of the file).
+    :param tail: return only last *tail* lines of the file, overrides offset
+        and end.
+    :return: :py:class:`LogChunk` instance. Returns Error string if id does
+        not exist and "Waiting ..." if no log is available yet.
+    """
     # Check if the job exists (file with it's id should be present in jobs
     # subdir)
     debug('@output - Progress log request')
-    if not os.path.isfile(os.path.join(conf.gate_path_jobs, id)):
+    _job = backend().job(id)
+    if not _job.exists():
         warning("@output - Job ID not found")
         return "Error: Job with ID:%s not found" % id
 
-    if os.path.exists(os.path.join(conf.gate_path_flag_delete, id)):
+    if _job.flag('delete'):
         debug("@output - Job marked for removal")
         return "Error: Job with ID:%s not found" % id
 
     # Return contents of progress.log file if it exists
-    _out_dir = os.path.join(conf.gate_path_output, id)
+    _out_dir = conf.output_path(id)
     _progress_log = os.path.join(_out_dir, 'progress.log')
     _output_log = os.path.join(_out_dir, 'output.log')
-    if os.path.exists(_progress_log):
-        with open(_progress_log) as _log:
-            return ''.join(_log.readlines())
+    if Storage.exists(_progress_log):
+        _path = _progress_log
     # If no progress.log was found return contents of output.log
-    elif (os.path.exists(os.path.join(conf.gate_path_done, id)) or
-          os.path.exists(os.path.join(conf.gate_path_failed, id))) and \
-            os.path.exists(_output_log):
-        with open(_output_log) as _log:
-            return ''.join(_log.readlines())
-
+    elif _job.state(('done', 'failed')) is not None and \
+            Storage.exists(_output_log):
+        _path = _output_log
     # All other cases
-    return "Waiting ..."
+    else:
+        return "Waiting ..."
+
+    _file = Storage.open_file(_path, 'rb')
+    try:
+        # Log may still grow, serve only the part that exists now
+        _stat = Storage.fstat(_file)
+        _size = _stat.st_size
+        if tail is not None:
+            _start = _tail_offset(_file, _size, tail)
+            _end = _size
+        else:
+            _start = offset if offset >= 0 else max(0, _size + offset)
+            _end = _size if end is None else min(end, _size)
+    except:
+        _file.close()
+        raise
+    return LogChunk(_file, os.path.basename(_path), _start, max(_start, _end),
+                    _size, _stat.st_mtime)
+
+
+def _tail_offset(file, size, lines, block=65536):
+    """
+    Find position of the first of the last *lines* lines in file by reading it
+    backwards. Trailing new line character at the end of file is ignored.
+    """
+    _pos = size
+    _count = 0
+    while _pos > 0 and lines > 0:
+        _step = min(block, _pos)
+        _pos -= _step
+        _data = Storage.pread(file, _pos, _step)
+        _idx = len(_data)
+        while True:
+            _idx = _data.rfind(b'\n', 0, _idx)
+            if _idx < 0:
+                break
+            if _pos + _idx == size - 1:
+                continue
+            _count += 1
+            if _count == lines:
+                return _pos + _idx + 1
+    return 0 if lines > 0 else size
+
+
+class LogChunk(object):
+    """
+    Part of a log file streamed in blocks when iterated over. The file is
+    closed after iteration or when :py:meth:`close` is called.
+    """
+
+    #: Size of blocks read from the log file
+    block_size = 65536
+
+    def __init__(self, file, name, start, end, size, mtime=None):
+        self.file = file
+        #: Name of the log file (progress.log or output.log)
+        self.name = name
+        #: Position of the first byte of the chunk
+        self.start = start
+        #: Position after the last byte of the chunk (offset to use in the
+        #: next request)
+        self.end = end
+        #: Size of the whole log file
+        self.size = size
+        #: Modification time of the log file
+        self.mtime = mtime
+
+    @property
+    def final(self):
+        """
+        Check if the log can not change anymore (output.log is served only
+        for finished jobs).
+        """
+        return self.name == 'output.log'
+
+    @property
+    def etag(self):
+        return '%x-%x' % (int(self.mtime * 1000000), self.size)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __iter__(self):
+        try:
+            _pos = self.start
+            while _pos < self.end:
+                _data = Storage.pread(self.file, _pos,
+                                      min(self.block_size, self.end - _pos))
+                if not _data:
+                    break
+                _pos += len(_data)
+                yield _data
+        finally:
+            self.close()
+
+    def close(self):
+        self.file.close()
 
 
 def delete(id):
@@ -238,18 +1023,21 @@ def delete(id):
 
     # Check if the job exists (file with it's id should be present in jobs
     # subdir)
-    debug("@delete - Job remove request %s" % id)
-    if not os.path.isfile(os.path.join(conf.gate_path_jobs, id)):
+    debug("@delete - Job remove request %s", id)
+    _job = backend().job(id)
+    if not _job.exists():
         warning("@delete - Job ID not found")
         return "Error: Job with ID:%s not found" % id
 
-    if os.path.exists(os.path.join(conf.gate_path_flag_delete, id)):
+    if _job.flag('delete'):
         warning("@delete - Job already marked for removal")
         return "Error: Job with ID:%s not found" % id
 
     try:
-        os.symlink(os.path.join(conf.gate_path_jobs, id),
-                   os.path.join(conf.gate_path_flag_delete, id))
+        if backend().set_flag('delete', (id,)):
+            return("Error: Unable to mark job %s for removal" % id)
+        terminal_cache.pop(id)
+        manifest_cache.pop(id)
     except:
         error("@delete - Unable to mark job for removal", exc_info=True)
         return("Error: Unable to mark job %s for removal" % id)
@@ -266,22 +1054,20 @@ def kill(id):
 
     # Check if the job exists (file with it's id should be present in jobs
     # subdir)
-    debug("@kill - Job remove request %s" % id)
-    if not os.path.isfile(os.path.join(conf.gate_path_jobs, id)):
+    debug("@kill - Job remove request %s", id)
+    _job = backend().job(id)
+    if not _job.exists():
         warning("@kill - Job ID not found")
         return "Error: Job with ID:%s not found" % id
 
-    if os.path.exists(os.path.join(conf.gate_path_flag_stop, id)):
+    if _job.flag('stop'):
         warning("@kill - Job already marked for a kill")
         return "Error: Job with ID:%s not found" % id
 
-    if os.path.exists(os.path.join(conf.gate_path_new, id)) or \
-       os.path.exists(os.path.join(conf.gate_path_waiting, id)) or \
-       os.path.exists(os.path.join(conf.gate_path_queued, id)) or \
-       os.path.exists(os.path.join(conf.gate_path_running, id)):
+    if _job.state(KILL_STATES) is not None:
         try:
-            os.symlink(os.path.join(conf.gate_path_jobs, id),
-                       os.path.join(conf.gate_path_flag_stop, id))
+            if backend().set_flag('stop', (id,)):
+                return("Error: Unable to mark job %s for a kill" % id)
         except:
             error("@kill - Unable to mark job for a kill", exc_info=True)
             return("Error: Unable to mark job %s for a kill" % id)
@@ -290,3 +1076,215 @@ def kill(id):
         return "Error: No active job with ID:%s found" % id
 
     return "Success"
+
+
+def bulk(action, ids=None, service=None, states=None, before=None,
+         prefix=None, dry_run=False):
+    """
+    Kill or delete many jobs selected by an ID list or a filter.
+
+    Matching jobs are resolved with a single pass over the state directories
+    (see :py:meth:`Backend.SymlinkBackend.find`), flags are created in batches
+    of gate_bulk_batch jobs.
+
+    :param action: "kill" or "delete".
+    :param ids: list of job IDs (can not be combined with the filter).
+    :param service: filter jobs of the service.
+    :param states: filter jobs in the states (default: states in which the
+        job can be killed for "kill", all states for "delete").
+    :param before: filter jobs submitted before the time (seconds since
+        epoch).
+    :param prefix: filter jobs with IDs starting with the prefix.
+    :param dry_run: only report matching jobs ("Matched"), do not set flags.
+    :return: dict mapping job IDs to results ("Success" or "Error: ...") or
+        error string for invalid request.
+    """
+    debug("@bulk - Bulk %s request", action)
+    _filter = (service, states, before, prefix)
+    if ids is not None:
+        if _filter != (None,) * len(_filter):
+            return "Error: Invalid request, job IDs can not be combined " \
+                "with a filter"
+        _jobs = backend().jobs(set(ids))
+        _result = dict((_id, "Error: Job with ID:%s not found" % _id)
+                       for _id in ids if _id not in _jobs)
+    else:
+        if _filter == (None,) * len(_filter):
+            return "Error: Missing job IDs or filter"
+        if states is None:
+            states = KILL_STATES if action == 'kill' else conf.service_states
+        for _state in states:
+            if _state not in conf.service_states:
+                return "Error: Invalid state: %s" % _state
+        _jobs = backend().find(states, service, prefix, before)
+        _result = {}
+
+    _flag = BULK_FLAGS[action]
+    _selected = []
+    for _id, _job in _jobs.items():
+        if _job.flag(_flag):
+            _result[_id] = "Error: Job with ID:%s not found" % _id
+        elif action == 'kill' and _job.state(KILL_STATES) is None:
+            _result[_id] = "Error: No active job with ID:%s found" % _id
+        else:
+            _selected.append(_id)
+    debug("@bulk - Matched %d jobs", len(_selected))
+
+    if dry_run:
+        for _id in _selected:
+            _result[_id] = "Matched"
+        return _result
+
+    _batch = max(1, conf.gate_bulk_batch)
+    for _idx in range(0, len(_selected), _batch):
+        _ids = _selected[_idx:_idx + _batch]
+        try:
+            _failed = set(backend().set_flag(_flag, _ids))
+        except:
+            error("@bulk - Unable to set %s flags", _flag, exc_info=True)
+            _failed = set(_ids)
+        for _id in _ids:
+            if _id in _failed:
+                _result[_id] = BULK_ERRORS[action] % _id
+                continue
+            _result[_id] = "Success"
+            if action == 'delete':
+                terminal_cache.pop(_id)
+                manifest_cache.pop(_id)
+    return _result
+
+
+#: Percentiles of ages of jobs reported by :py:func:`stats`
+AGE_PERCENTILES = (50, 90, 99)
+
+#: Last computed job statistics
+stats_sample = {'time': 0.0, 'stats': None}
+stats_lock = threading.Lock()
+
+
+def stats():
+    """
+    Return aggregated job statistics: number of jobs per state and service
+    and ages of jobs in states listed in :py:data:`Index.AGE_STATES`.
+    Statistics are computed at most once per gate_stats_interval seconds.
+    With the state index (gate_state_index) the cost does not depend on the
+    number of jobs. Otherwise the numbers come from the sampled
+    :py:meth:`Backend.SymlinkBackend.counts` (the index is not started) and
+    ages are not reported.
+
+    :return: dict with "counts" (state -> service -> number of jobs),
+        "totals" (state -> number of jobs), "ages" (state -> dict with
+        number of jobs, age of the oldest job and age percentiles, in seconds,
+        only with the state index), "snapshot_age" (age of the statistics in
+        seconds) and "retention" (see
+        :py:meth:`Retention.RetentionSweeper.stats`, only when retention is
+        configured).
+    """
+    with stats_lock:
+        if time.time() - stats_sample['time'] >= conf.gate_stats_interval:
+            stats_sample['stats'], _age = _compute_stats()
+            stats_sample['time'] = time.time() - _age
+        _stats = dict(stats_sample['stats'])
+        _stats['snapshot_age'] = time.time() - stats_sample['time']
+    if conf.gate_retention:
+        _stats['retention'] = sweeper.stats()
+    return _stats
+
+
+def _compute_stats():
+    """
+    Compute job statistics (see :py:func:`stats`).
+
+    :return: tuple (statistics, age of the data in seconds)
+    """
+    if not conf.gate_state_index:
+        _counts, _age = backend().counts()
+        return {'counts': _counts, 'totals': _totals(_counts)}, _age
+
+    if not index.started:
+        index.start()
+    _now = time.time()
+    _counts = dict(
+        (_state, index.service_counts(_state))
+        for _state in conf.service_states
+    )
+    return {
+        'counts': _counts,
+        'totals': _totals(_counts),
+        'ages': dict(
+            (_state, _age_stats(index.entry_times(_state), _now))
+            for _state in AGE_STATES
+        ),
+    }, 0.0
+
+
+def _totals(counts):
+    """
+    Return number of jobs per state for counts per state and service.
+    """
+    return dict(
+        (_state, sum(_services.values()))
+        for _state, _services in counts.items()
+    )
+
+
+def _age_stats(times, now):
+    """
+    Return statistics of job ages.
+
+    :param times: list of tuples (time, number of jobs) sorted by time, as
+        returned by :py:meth:`StateIndex.entry_times`.
+    """
+    _total = sum(_count for _, _count in times)
+    _stats = {'count': _total, 'oldest': None}
+    for _percentile in AGE_PERCENTILES:
+        _stats['p%d' % _percentile] = None
+    if not _total:
+        return _stats
+
+    _stats['oldest'] = max(0.0, now - times[0][0])
+    _percentiles = list(AGE_PERCENTILES)
+    _seen = 0
+    # Walk from the youngest jobs, the percentile is the age of the job at
+    # its rank
+    for _time, _count in reversed(times):
+        _seen += _count
+        while _percentiles and \
+                _seen * 100 >= _percentiles[0] * _total:
+            _stats['p%d' % _percentiles.pop(0)] = max(0.0, now - _time)
+        if not _percentiles:
+            break
+    return _stats
+
+
+def _collect_metrics():
+    """
+    Metrics collector exposing job counts and terminal results cache stats.
+    """
+    _jobs = Metrics.Gauge('appgw_jobs', 'Number of jobs per state and service.',
+                          labels=('state', 'service'))
+    _age = Metrics.Gauge('appgw_jobs_sample_age_seconds',
+                         'Age of the number of jobs data.')
+    try:
+        _counts, _sample_age = backend().counts()
+        for _state, _services in _counts.items():
+            for _service, _count in _services.items():
+                _jobs.set(_count, (_state, _service))
+        _age.set(_sample_age)
+    except:
+        error("@metrics - Unable to count jobs", exc_info=True)
+
+    _stats = terminal_cache.stats()
+    _metrics = [_jobs, _age]
+    for _name, _type in (('size', 'gauge'), ('hits', 'counter'),
+                         ('misses', 'counter'), ('evictions', 'counter')):
+        _metric = Metrics.Gauge(
+            'appgw_terminal_cache_%s%s' %
+            (_name, '_total' if _type == 'counter' else ''),
+            'Terminal job results cache %s.' % _name, type=_type)
+        _metric.set(_stats[_name])
+        _metrics.append(_metric)
+    return _metrics
+
+
+Metrics.register_collector(_collect_metrics)
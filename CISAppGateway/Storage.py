@@ -0,0 +1,224 @@
+"""
+Blocking file system operations used by AppGateway.
+
+All access to the shared storage and to the jobs output goes through this
+module. By default operations are executed directly in the calling thread. The
+asynchronous entry point (see :py:mod:`CISAppGateway.Async`) installs an
+executor that runs them in a bounded thread pool, so waiting on slow storage
+does not block the event loop. Only the operations themselves are run by the
+executor, the gateway logic (and locking) stays in the calling thread.
+
+Every operation is counted and timed per file system and operation name and
+recorded as a span of the current request trace (see
+:py:mod:`CISAppGateway.Trace`).
+"""
+
+import os
+import time
+import errno
+import threading
+
+from CISAppGateway import Metrics, Trace
+from CISAppGateway.Config import conf
+
+#: Key of the shared storage used to communicate with AppServer (every
+#: shared storage volume has its own key, see :py:func:`volume_filesystem`)
+SHARED = 'shared'
+#: Key of the storage holding jobs output
+OUTPUT = 'output'
+#: Key of the job states database (see :py:class:`Backend.SQLiteBackend`)
+DATABASE = 'database'
+
+#: Executor used to run blocking operations (*None* runs them directly). Has
+#: to implement run(fs, func, *args, **kwargs) method.
+executor = None
+
+operation_duration = Metrics.Histogram(
+    'appgw_fs_operation_duration_seconds',
+    'Duration of file system operations.',
+    labels=('fs', 'op'),
+)
+operation_errors = Metrics.Counter(
+    'appgw_fs_operation_errors_total',
+    'Number of failed file system operations.',
+    labels=('fs', 'op'),
+)
+
+#: Per thread (per request) counter of file system operations
+_local = threading.local()
+
+
+def offload(fs, func, *args, **kwargs):
+    """
+    Run a blocking operation.
+
+    :param fs: key of the file system accessed by the operation (used to
+        limit concurrency per file system).
+    :param func: callable to run. Its name is used as the operation name in
+        metrics.
+    :return: value returned by func.
+    """
+    _labels = (fs, getattr(func, '__name__', 'call').lstrip('_'))
+    _local.operations = getattr(_local, 'operations', 0) + 1
+    _start = time.time()
+    try:
+        if executor is None:
+            return func(*args, **kwargs)
+        return executor.run(fs, func, *args, **kwargs)
+    except:
+        operation_errors.inc(_labels)
+        raise
+    finally:
+        _duration = time.time() - _start
+        operation_duration.observe(_duration, _labels)
+        Trace.span(':'.join(_labels), _start, _duration)
+
+
+def reset_operations():
+    """
+    Reset the counter of file system operations performed by the current
+    thread (e.g. at the beginning of a request).
+    """
+    _local.operations = 0
+
+
+def operations():
+    """
+    Return number of file system operations performed by the current thread
+    since the last :py:func:`reset_operations` call.
+    """
+    return getattr(_local, 'operations', 0)
+
+
+def filesystem(path):
+    """
+    Return key of the file system the path belongs to.
+    """
+    for _volume in conf.volumes.values():
+        if path.startswith(_volume.output + os.sep):
+            return volume_filesystem(OUTPUT, _volume.name)
+    for _volume in conf.volumes.values():
+        if path.startswith(_volume.shared + os.sep):
+            return volume_filesystem(SHARED, _volume.name)
+    return SHARED
+
+
+def volume_filesystem(fs, name):
+    """
+    Return key of a file system (:py:data:`SHARED` or :py:data:`OUTPUT`) of a
+    shared storage volume: "<fs>:<name>", plain fs for the default volume.
+    """
+    if not name:
+        return fs
+    return '%s:%s' % (fs, name)
+
+
+def exists(path):
+    return offload(filesystem(path), os.path.exists, path)
+
+
+def isfile(path):
+    return offload(filesystem(path), os.path.isfile, path)
+
+
+def stat(path):
+    return offload(filesystem(path), os.stat, path)
+
+
+def lstat(path):
+    return offload(filesystem(path), os.lstat, path)
+
+
+def listdir(path):
+    return offload(filesystem(path), os.listdir, path)
+
+
+def list_jobs(path):
+    """
+    Return names of job entries in a job directory. Hash-prefix
+    subdirectories of the sharded layout (see :py:meth:`Config.shard`) are
+    listed recursively.
+    """
+    _result = []
+    _dirs = [(path, 0)]
+    while _dirs:
+        _dir, _depth = _dirs.pop()
+        for _name in listdir(_dir):
+            if conf.is_shard(_name, _depth):
+                _dirs.append((os.path.join(_dir, _name), _depth + 1))
+            else:
+                _result.append(_name)
+    return _result
+
+
+def makedirs(path):
+    """
+    Create directory along with missing parents. Does nothing if the
+    directory already exists.
+    """
+    return offload(filesystem(path), _makedirs, path)
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def symlink(source, link_name):
+    return offload(filesystem(link_name), os.symlink, source, link_name)
+
+
+def symlink_job(source, link_name):
+    """
+    Create symbolic link to a job file creating the hash-prefix subdirectory
+    of the link if it does not exist yet.
+    """
+    try:
+        symlink(source, link_name)
+    except OSError as e:
+        if e.errno != errno.ENOENT or not conf.gate_shard_levels:
+            raise
+        makedirs(os.path.dirname(link_name))
+        symlink(source, link_name)
+
+
+def open_file(path, mode='r'):
+    return offload(filesystem(path), open, path, mode)
+
+
+def read_file_stat(path):
+    """
+    Return the whole contents of a file along with its stat result.
+    """
+    return offload(filesystem(path), _read_file_stat, path)
+
+
+def _read_file_stat(path):
+    with open(path) as _file:
+        return _file.read(), os.fstat(_file.fileno())
+
+
+def fstat(file):
+    return offload(filesystem(file.name), os.fstat, file.fileno())
+
+
+def read(file, size):
+    """
+    Read at most size bytes from an open file.
+    """
+    return offload(filesystem(file.name), file.read, size)
+
+
+def pread(file, offset, size):
+    """
+    Read at most size bytes from an open file starting at offset.
+    """
+    return offload(filesystem(file.name), _pread, file, offset, size)
+
+
+def _pread(file, offset, size):
+    file.seek(offset)
+    return file.read(size)
@@ -0,0 +1,142 @@
+"""
+Per-request tracing.
+
+Every request is assigned an ID (taken from the "X-Request-ID" header when
+present). Blocking operations run through :py:func:`Storage.offload` are
+recorded as spans of the current request. When the request finishes its
+trace is logged only if the request was sampled (gate_trace_sample) or took
+longer than gate_trace_slow seconds, otherwise it is dropped. Time requests
+spend waiting on purpose (long-polls of /watch) is not counted towards
+gate_trace_slow.
+"""
+
+import time
+import uuid
+import random
+import logging
+import threading
+
+#: Name of the logger used to emit traces (has its own level, so traces are
+#: logged regardless of log_level)
+TRACE_LOGGER = 'CISAppGateway.trace'
+#: Maximum number of spans recorded per request
+MAX_SPANS = 256
+
+_logger = logging.getLogger(TRACE_LOGGER)
+
+#: Per thread (per request) trace
+_local = threading.local()
+
+
+class RequestTrace(object):
+    """
+    Spans recorded during a single request.
+    """
+    __slots__ = ('id', 'name', 'start', 'spans', 'dropped', 'idle')
+
+    def __init__(self, id, name):
+        self.id = id
+        #: Description of the request (e.g. method and path)
+        self.name = name
+        self.start = time.time()
+        #: List of tuples (label, start, duration)
+        self.spans = []
+        #: Number of spans not recorded because of MAX_SPANS
+        self.dropped = 0
+        #: Time (in seconds) spent waiting for events, e.g. job status changes
+        self.idle = 0.0
+
+    def format(self, status, duration):
+        """
+        Return multi-line description of the trace.
+        """
+        _lines = [
+            "@trace - Request %s %s -> %s: %.3f s, %d operations" %
+            (self.id, self.name, status, duration,
+             len(self.spans) + self.dropped)
+        ]
+        if self.idle:
+            _lines[0] += " (%.3f s idle)" % self.idle
+        for _label, _start, _duration in self.spans:
+            _lines.append("    +%.6f %.6f %s" %
+                          (_start - self.start, _duration, _label))
+        if self.dropped:
+            _lines.append("    ... %d more operations" % self.dropped)
+        return '\n'.join(_lines)
+
+
+def start(name, id=None):
+    """
+    Start trace of a request handled by the current thread.
+
+    :param name: description of the request.
+    :param id: request ID, a random one is generated when *None*.
+    :return: request ID
+    """
+    if id is None:
+        id = uuid.uuid4().hex
+    _local.trace = RequestTrace(id, name)
+    return id
+
+
+def span(label, start, duration):
+    """
+    Record an operation performed by the current request. Does nothing
+    outside of a traced request.
+    """
+    _trace = getattr(_local, 'trace', None)
+    if _trace is None:
+        return
+    if len(_trace.spans) < MAX_SPANS:
+        _trace.spans.append((label, start, duration))
+    else:
+        _trace.dropped += 1
+
+
+def idle(duration):
+    """
+    Record time the current request spent waiting for events (not counted
+    as slow). Does nothing outside of a traced request.
+    """
+    _trace = getattr(_local, 'trace', None)
+    if _trace is not None:
+        _trace.idle += duration
+
+
+def finish(status, sample, slow):
+    """
+    Finish trace of the current request and log it if it was sampled or
+    slow.
+
+    :param status: status of the request (e.g. HTTP status code).
+    :param sample: fraction of requests to log.
+    :param slow: minimal duration (in seconds, without the idle time) of a
+        request logged as slow (0 disables).
+    :return: duration of the request in seconds.
+    """
+    _trace = getattr(_local, 'trace', None)
+    if _trace is None:
+        return None
+    _local.trace = None
+    _duration = time.time() - _trace.start
+    if slow and _duration - _trace.idle >= slow:
+        _logger.warning(Lazy(_trace.format, status, _duration))
+    elif sample and random.random() < sample:
+        _logger.info(Lazy(_trace.format, status, _duration))
+    return _duration
+
+
+class Lazy(object):
+    """
+    Log message argument built only when the message is formatted, e.g.:
+
+        debug('Request %s', Lazy(json.dumps, request))
+    """
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
@@ -5,9 +5,115 @@ implement server response to API requests - each request is defined as specific
 URL.
 """
 
-from flask import request
+try:
+    import json
+except:
+    import simplejson as json
 
-from CISAppGateway import app, Server
+import time
+import hashlib
+import datetime
+import mimetypes
+
+from flask import request, jsonify, Response, g
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file
+
+from CISAppGateway import app, Api, Server, Storage, Metrics, Trace
+from CISAppGateway.Admission import admission
+from CISAppGateway.Config import conf, reloader
+from CISAppGateway.Retention import sweeper
+from CISAppGateway.Watch import watcher
+
+
+request_duration = Metrics.Histogram(
+    'appgw_http_request_duration_seconds',
+    'Time spent handling requests (until the response body is returned).',
+    labels=('route',),
+)
+request_count = Metrics.Counter(
+    'appgw_http_requests_total',
+    'Number of handled requests.',
+    labels=('route', 'method', 'status'),
+)
+request_operations = Metrics.Histogram(
+    'appgw_http_request_fs_operations',
+    'Number of file system operations performed per request.',
+    labels=('route',),
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+
+
+@app.before_first_request
+def _configure():
+    app.debug = conf.gate_debug
+    sweeper.start()
+    reloader.start()
+
+
+@app.before_request
+def _request_started():
+    g.request_start = time.time()
+    g.request_id = Trace.start(request.method + ' ' + request.path,
+                               request.headers.get('X-Request-ID'))
+    Storage.reset_operations()
+    g.format = Api.response_format(request)
+    if g.format is None:
+        return Api.unsupported_format()
+
+
+@app.after_request
+def _request_finished(response):
+    if request.url_rule is not None:
+        _route = request.url_rule.rule
+    else:
+        _route = 'unmatched'
+    request_duration.observe(time.time() - g.request_start, (_route,))
+    request_operations.observe(Storage.operations(), (_route,))
+    request_count.inc((_route, request.method, str(response.status_code)))
+    Trace.finish(response.status_code, conf.gate_trace_sample,
+                 conf.gate_trace_slow)
+    response.headers['X-Request-ID'] = g.request_id
+    return Api.compress(request, response)
+
+
+def _v3():
+    """
+    Check if the client requested API version 3 responses (see
+    :py:mod:`CISAppGateway.Api`).
+    """
+    return g.format == Api.V3
+
+
+def _error(message, status=None):
+    """
+    Return error response in the format requested by the client.
+
+    :param status: HTTP status of the legacy response (200 if *None*).
+    """
+    if _v3():
+        return Api.error(message)
+    if status is None:
+        return message
+    return message, status
+
+
+def _result(result, id=None, key='id'):
+    """
+    Return response for a result of an operation on a job (Job ID, URL or
+    "Success") or an Error string in the format requested by the client.
+
+    :param id: Job ID (when not returned as the result).
+    :param key: name of the API version 3 document field holding the result.
+    """
+    if not _v3():
+        return result
+    if result.startswith('Error:'):
+        return Api.error(result, id)
+    _data = {key: result}
+    if id is not None:
+        _data['id'] = id
+    return Api.document(_data)
 
 
 @app.route('/')
@@ -24,11 +130,120 @@ def submit():
     standard FORM format or as JSON payload identified by header:
     'Content-Type' = 'application/json'. Returns JOB ID upon success, error
     otherwise.
+
+    Optional 'Idempotency-Key' header identifies the submission. Retrying it
+    with the same key returns JOB ID of the job created by the first attempt.
+
+    Large requests can be streamed: "service" and "api" are passed as URL
+    arguments (/submit?service=<service>&api=<api>) and the payload holds
+    JSON object with the remaining attributes. The payload is written to the
+    job file as it is received.
+
+    When the backlog of the service exceeds its limit returns error with 503
+    status, when the client exceeds its submission rate returns error with
+    429 status. The 'Retry-After' header holds number of seconds after which
+    the request should be retried.
+
+    API version 3 responses hold JSON object with "id" field.
     """
+    _key = request.headers.get('Idempotency-Key')
+    if 'service' in request.args:
+        _service = request.args['service']
+        _limit = Server.submit_max_size(_service)
+        if request.content_length is not None and \
+                request.content_length > _limit:
+            return _error(
+                'Error: Request too large (limit: %d bytes)' % _limit, 413)
+        _rejected = _admit([_service])
+        if _rejected is not None:
+            return _rejected
+        return _result(Server.submit_stream(
+            _service, request.args.get('api'), request.stream, _key))
     if request.headers['Content-Type'] == 'application/json':
-        return Server.submit(request.json)
+        _request = request.json
     else:
-        return Server.submit(request.form)
+        _request = request.form
+    _rejected = _admit(_services([_request]))
+    if _rejected is not None:
+        return _rejected
+    return _result(Server.submit(_request, _key))
+
+
+@app.route('/submit_batch', methods=['POST'])
+def submit_batch():
+    """
+    Multiple jobs submit request. Expects a POST request (@ /submit_batch URL)
+    with JSON payload holding a list of requests in the format accepted by
+    /submit. Returns JSON list with JOB ID or error for every request (in the
+    same order). The whole batch is rejected when any of its services is
+    overloaded or the client exceeds its submission rate (see /submit).
+    """
+    _requests = request.get_json(force=True, silent=True)
+    if not isinstance(_requests, list):
+        return _error('Error: Expected a list of requests')
+    if len(_requests) > conf.gate_submit_batch_max:
+        return _error('Error: Too many requests in a batch (limit: %d)' %
+                      conf.gate_submit_batch_max)
+    _rejected = _admit(_services(_requests))
+    if _rejected is not None:
+        return _rejected
+    _results = Server.submit_batch(_requests)
+    if _v3():
+        return Api.document({'jobs': [
+            Api.error_data(_result) if _result.startswith('Error:') else
+            {'id': _result} for _result in _results
+        ]})
+    return Response(json.dumps(_results), mimetype='application/json')
+
+
+def _services(requests):
+    """
+    Return names of services requested by job requests (invalid requests
+    are skipped).
+    """
+    return [_request['service'] for _request in requests
+            if isinstance(_request, dict) and 'service' in _request]
+
+
+def _client():
+    """
+    Return identifier of the client used for its submission rate limit: name
+    of the authenticated user, address reported by a trusted reverse proxy
+    in gate_client_header or address of the peer.
+    """
+    if request.remote_user:
+        return 'user:' + request.remote_user
+    _address = request.remote_addr
+    if conf.gate_client_header and _address in conf.gate_trusted_proxies:
+        _hops = request.headers.get(conf.gate_client_header, '').split(',')
+        # The rightmost address not added by a trusted proxy
+        for _hop in reversed(_hops):
+            _hop = _hop.strip()
+            if not _hop:
+                continue
+            _address = _hop
+            if _hop not in conf.gate_trusted_proxies:
+                break
+    return _address
+
+
+def _admit(services):
+    """
+    Check if jobs for services can be submitted by the client.
+
+    :return: Error response or *None* if the jobs are accepted.
+    """
+    _rejection = admission.admit(services, _client())
+    if _rejection is None:
+        return None
+    if _v3():
+        _response = Api.error_document(
+            'overloaded' if _rejection.status == 503 else 'rate_limited',
+            _rejection.status, _rejection.message)
+    else:
+        _response = Response(_rejection.message, status=_rejection.status)
+    _response.headers['Retry-After'] = str(_rejection.retry_after)
+    return _response
 
 
 @app.route('/status/<id>')
@@ -45,8 +260,144 @@ def status(id):
     * failed
     * aborted
     * killed
+
+    Responses carry 'ETag' and 'Last-Modified' headers (time the job entered
+    its state, only when known, see :py:func:`Server.status_info`) and are
+    cacheable (see :py:func:`_cacheable`), conditional requests are answered
+    with 304 status when the status did not change.
+
+    API version 3 responses hold JSON object with "id", "state", "updated"
+    (time the job entered the state) and "message" (exit message of finished
+    jobs) fields.
+    """
+    _info = Server.status_info(id)
+    if _info.state is None:
+        return _error(_info.status)
+    if _v3():
+        return _cacheable(Api.document(Api.status_data(id, _info)),
+                          _info.etag + '-v3', _info.mtime, _info.terminal)
+    return _cacheable(Response(_info.status), _info.etag, _info.mtime,
+                      _info.terminal)
+
+
+@app.route('/status', methods=['POST'])
+def status_many():
     """
-    return Server.status(id)
+    Multiple jobs status request. Expects a POST request (@ /status URL) with
+    list of Job IDs as JSON payload (identified by header: 'Content-Type' =
+    'application/json') or as "id" fields in standard FORM format. Returns
+    JSON object mapping Job IDs to job statuses as returned by /status/<id>.
+    API version 3 response holds the statuses in "jobs" object.
+    """
+    if request.headers.get('Content-Type') == 'application/json':
+        _ids = request.json
+        if isinstance(_ids, dict):
+            _ids = _ids.get('ids')
+    else:
+        _ids = request.form.getlist('id')
+    if not isinstance(_ids, list) or \
+            not all(isinstance(_id, basestring) for _id in _ids):
+        return _error('Error: Expected a list of job IDs')
+    if _v3():
+        return Api.document({'jobs': dict(
+            (_id, Api.status_data(_id, _info))
+            for _id, _info in Server.status_info_many(_ids).items()
+        )})
+    return jsonify(Server.status_many(_ids))
+
+
+@app.route('/watch/<id>')
+def watch(id):
+    """
+    Job status change request. Expects GET request on /watch/<id> URL, where
+    <id> is the Job ID returned during submission. Optional "since" argument
+    holds the status last seen by the client. The response is sent as soon as
+    the job status differs from "since" or after "timeout" seconds (limited by
+    the server configuration). Returns job status in the same format as
+    /status/<id>.
+
+    When the client accepts 'text/event-stream' the connection is kept open
+    and status changes are sent as Server-Sent-Events until the job finishes.
+
+    API version 3 responses hold JSON object with "id" and "status" (to be
+    passed as "since") fields, errors are reported as for /status/<id>.
+    """
+    return _watch({id: request.args.get('since')}, single=True)
+
+
+@app.route('/watch', methods=['GET', 'POST'])
+def watch_many():
+    """
+    Multiple jobs status change request. Expects GET request on /watch URL with
+    Job IDs passed as "id" arguments and optional last seen statuses passed as
+    "since" arguments (in the same order), or a POST request with JSON object
+    mapping Job IDs to last seen statuses (null when unknown). Returns JSON
+    object mapping Job IDs to job statuses as soon as status of any of the jobs
+    changes or after "timeout" seconds. Server-Sent-Events are supported as
+    for /watch/<id>.
+
+    API version 3 responses hold JSON object with "jobs" field mapping Job IDs
+    to objects in the format of /watch/<id> responses (or error
+    descriptions).
+    """
+    if request.method == 'POST':
+        _since = request.get_json(force=True, silent=True)
+        if not isinstance(_since, dict):
+            return _error('Error: Expected a JSON object with job IDs')
+    else:
+        _ids = request.args.getlist('id')
+        _states = request.args.getlist('since')
+        _states += [None] * (len(_ids) - len(_states))
+        _since = dict(zip(_ids, _states))
+    if not _since:
+        return _error('Error: Expected a list of job IDs')
+    return _watch(_since, single=False)
+
+
+def _watch(since, single):
+    """
+    Common implementation of /watch requests.
+
+    :param since: dict mapping job IDs to last seen statuses.
+    :param single: return plain status string instead of JSON object.
+    """
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        return Response(_watch_events(since), mimetype='text/event-stream')
+
+    try:
+        _timeout = float(request.args.get('timeout', conf.gate_watch_timeout))
+    except ValueError:
+        return _error('Error: Invalid timeout')
+    _timeout = max(0, min(_timeout, conf.gate_watch_timeout))
+    _start = time.time()
+    _current = watcher.wait(since, _timeout)
+    # Long-polls are slow on purpose
+    Trace.idle(time.time() - _start)
+    if single:
+        _id, _status = list(_current.items())[0]
+        if _status is None or _status.startswith('Error:'):
+            return _error(_status or 'Error: Unable to check job status')
+        if _v3():
+            return Api.document(Api.watch_data(_id, _status))
+        return _status
+    if _v3():
+        return Api.document({'jobs': dict(
+            (_id, Api.watch_data(_id, _status))
+            for _id, _status in _current.items()
+        )})
+    return jsonify(_current)
+
+
+def _watch_events(since):
+    """
+    Format job status changes as Server-Sent-Events.
+    """
+    for _event in watcher.events(since, conf.gate_watch_keepalive):
+        if _event is None:
+            yield ': keepalive\n\n'
+        else:
+            _data = json.dumps({'id': _event[0], 'status': _event[1]})
+            yield 'event: status\ndata: %s\n\n' % _data
 
 
 @app.route('/output/<id>')
@@ -56,9 +407,79 @@ def output(id):
     the Job ID returned during submission. Returns base URL for job output
     files. Client is expected to know the actual file names or browse contents
     of the output directory at http server. If job does not exist returns an
-    error.
+    error. API version 3 response holds JSON object with "id" and "url"
+    fields.
     """
-    return Server.output(id)
+    _url = Server.output(id)
+    if _url.startswith('Error:'):
+        return _error(_url)
+    _etag = hashlib.md5(_url.encode('utf-8')).hexdigest()
+    if _v3():
+        return _cacheable(_result(_url, id, 'url'), _etag + '-v3', None, True)
+    return _cacheable(Response(_url), _etag, None, True)
+
+
+@app.route('/output/<id>/files')
+def output_files(id):
+    """
+    Job output manifest request. Expects GET request on /output/<id>/files
+    URL, where <id> is the Job ID returned during submission. Returns JSON
+    object with base URL for job output files ("url") and list of output
+    files ("files") with their "name" (path relative to the job output
+    directory), "size" and "mtime". If job does not exist or has not finished
+    returns an error.
+    """
+    _manifest = Server.output_manifest(id)
+    if not isinstance(_manifest, Server.OutputManifest):
+        return _error(_manifest)
+    return _cacheable(Response(_manifest.json, mimetype='application/json'),
+                      _manifest.etag, None, True)
+
+
+@app.route('/output/<id>/<path:path>')
+def output_file(id, path):
+    """
+    Job output file request. Expects GET request on /output/<id>/<path> URL,
+    where <id> is the Job ID returned during submission and <path> is a file
+    name listed in the job output manifest (a file called "files" in the top
+    of the output directory is only available via the http server). Supports
+    "Range", "If-None-Match" and "If-Modified-Since" headers. Sending of the
+    file can be delegated to the front-end web server (gate_output_offload).
+    Returns error with 404 status if the file is not available.
+    """
+    _path = Server.output_file(id, path)
+    if _path.startswith('Error:'):
+        return _error(_path, 404)
+
+    if conf.gate_output_offload == 'x-accel-redirect':
+        _response = Response()
+        _response.headers['X-Accel-Redirect'] = \
+            conf.volume(id).accel_prefix + id + '/' + path
+        return _response
+    if conf.gate_output_offload == 'x-sendfile':
+        _response = Response()
+        _response.headers['X-Sendfile'] = _path
+        return _response
+
+    try:
+        _file = Storage.open_file(_path, 'rb')
+    except (IOError, OSError):
+        return _error('Error: File %s not found in output of job with ID:%s'
+                      % (path, id), 404)
+    _stat = Storage.fstat(_file)
+    # The file wrapper of the WSGI server is able to use sendfile
+    _response = Response(wrap_file(request.environ, _file),
+                         mimetype=mimetypes.guess_type(path)[0] or
+                         'application/octet-stream',
+                         direct_passthrough=True)
+    _response.content_length = _stat.st_size
+    _response.last_modified = int(_stat.st_mtime)
+    _response.set_etag('%x-%x' % (int(_stat.st_mtime * 1000000),
+                                  _stat.st_size))
+    _response.cache_control.public = True
+    _response.cache_control.max_age = conf.gate_http_max_age_terminal
+    return _response.make_conditional(request, accept_ranges=True,
+                                      complete_length=_stat.st_size)
 
 
 @app.route('/progress/<id>')
@@ -70,8 +491,102 @@ def progress(id):
     job log or info about its progress. For jobs that do not generate
     "progress.log" the "output.log" is returned when job enters 'done' or
     'failed' state. If job does not exist returns an error.
+
+    Parts of the log can be requested with "offset" argument (returns bytes
+    starting at offset), "tail" argument (returns last N lines) or a standard
+    "Range" header. Position that should be used as "offset" in the next
+    request is returned in "X-Progress-Offset" header, the name of the log
+    file in "X-Progress-Log" header.
+
+    'ETag' and 'Last-Modified' headers describe the log file, conditional
+    requests are answered with 304 status when the log did not change.
+
+    API version 3 clients get errors as JSON objects and 204 status when no
+    log is available yet, the log itself is returned as plain text.
+    """
+    _range = request.range
+    try:
+        _offset = int(request.args.get('offset', 0))
+        _tail = request.args.get('tail')
+        if _tail is not None:
+            _tail = max(0, int(_tail))
+    except ValueError:
+        return _error('Error: Invalid offset or tail')
+    _end = None
+    if _range is not None:
+        if len(_range.ranges) != 1:
+            return _error('Error: Multiple ranges are not supported')
+        _offset, _end = _range.ranges[0]
+
+    _log = Server.progress_log(id, offset=_offset, end=_end, tail=_tail)
+    if not isinstance(_log, Server.LogChunk):
+        if not _log.startswith('Error:') and _v3():
+            return Response(status=204)
+        return _error(_log)
+
+    _mtime = datetime.datetime.utcfromtimestamp(int(_log.mtime))
+    if not is_resource_modified(request.environ, etag=_log.etag,
+                                last_modified=_mtime):
+        _log.close()
+        _response = _cache_headers(Response(status=304), _log.etag,
+                                   _log.mtime, _log.final)
+        _response.headers['X-Progress-Offset'] = str(_log.end)
+        _response.headers['X-Progress-Log'] = _log.name
+        return _response
+
+    if _range is not None and _log.start >= _log.size:
+        # Nothing new in the log
+        _log.close()
+        _response = Response(status=416)
+        _response.headers['Content-Range'] = 'bytes */%d' % _log.size
+        _response.headers['X-Progress-Offset'] = str(_log.size)
+        _response.headers['X-Progress-Log'] = _log.name
+        return _response
+
+    _response = _cache_headers(Response(_log, mimetype='text/plain'),
+                               _log.etag, _log.mtime, _log.final)
+    _response.headers['Accept-Ranges'] = 'bytes'
+    _response.headers['X-Progress-Offset'] = str(_log.end)
+    _response.headers['X-Progress-Log'] = _log.name
+    _response.content_length = len(_log)
+    if _range is not None:
+        _response.status_code = 206
+        _response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+            _log.start, _log.end - 1, _log.size)
+    return _response
+
+
+def _cache_headers(response, etag, mtime, final):
+    """
+    Set validators and 'Cache-Control' header of a response.
+
+    :param etag: entity tag of the response.
+    :param mtime: modification time of the resource (*None* if not known).
+    :param final: the resource can not change anymore (job in terminal
+        state), the response can be cached for gate_http_max_age_terminal
+        seconds instead of gate_http_max_age_active.
+    """
+    response.set_etag(etag)
+    if mtime is not None:
+        response.last_modified = int(mtime)
+    # Representation can be selected with the Accept header (API version 3)
+    response.vary.add('Accept')
+    response.cache_control.public = True
+    if final:
+        response.cache_control.max_age = conf.gate_http_max_age_terminal
+    else:
+        response.cache_control.max_age = conf.gate_http_max_age_active
+    return response
+
+
+def _cacheable(response, etag, mtime, final):
     """
-    return Server.progress(id)
+    Set caching headers of a response (see :py:func:`_cache_headers`) and
+    turn it into 304 Not Modified response when the client's copy is
+    current.
+    """
+    _cache_headers(response, etag, mtime, final)
+    return response.make_conditional(request)
 
 
 @app.route('/delete/<id>')
@@ -80,9 +595,10 @@ def delete(id):
     Job delete request. Expects GET request on /delete/<id> URL, where <id> is
     the Job ID returned during submission. If job is queued or running it will
     be killed. All files related to the job will be removed. If job does not
-    exist returns an error.
+    exist returns an error. API version 3 response holds JSON object with "id"
+    and "result" fields.
     """
-    return Server.delete(id)
+    return _result(Server.delete(id), id, 'result')
 
 
 @app.route('/kill/<id>')
@@ -90,6 +606,102 @@ def kill(id):
     """
     Job kill request. Expects GET request on /kill/<id> URL, where <id> is
     the Job ID returned during submission. If job is queued or running it will
-    be killed. If job does not exist or has finished returns an error.
+    be killed. If job does not exist or has finished returns an error. API
+    version 3 response holds JSON object with "id" and "result" fields.
+    """
+    return _result(Server.kill(id), id, 'result')
+
+
+@app.route('/delete', methods=['POST'])
+def delete_many():
+    """
+    Multiple jobs delete request. Expects a POST request (@ /delete URL) with
+    JSON object selecting the jobs (see :py:func:`_bulk`). Jobs in all states
+    are deleted unless "states" are given.
+    """
+    return _bulk('delete')
+
+
+@app.route('/kill', methods=['POST'])
+def kill_many():
+    """
+    Multiple jobs kill request. Expects a POST request (@ /kill URL) with JSON
+    object selecting the jobs (see :py:func:`_bulk`). Only jobs in new,
+    waiting, queued and running states are killed.
+    """
+    return _bulk('kill')
+
+
+def _bulk(action):
+    """
+    Common implementation of bulk delete and kill requests. The JSON object
+    holds either a list of Job IDs ("ids") or a filter combining "service",
+    list of "states", "before" (jobs submitted before the time in seconds
+    since epoch) and Job ID "prefix". With "dry_run" set to true the matching
+    jobs are reported and left intact.
+
+    Returns JSON object mapping Job IDs to results as returned by
+    /delete/<id> and /kill/<id> ("Matched" in dry run). API version 3
+    response holds the results in "jobs" object along with "dry_run" field.
+    """
+    _request = request.get_json(force=True, silent=True)
+    if not isinstance(_request, dict):
+        return _error('Error: Expected a JSON object with job IDs or filter')
+    _ids = _request.get('ids')
+    _states = _request.get('states')
+    _before = _request.get('before')
+    _dry_run = bool(_request.get('dry_run', False))
+    if _ids is not None and (
+            not isinstance(_ids, list) or
+            not all(isinstance(_id, basestring) for _id in _ids)):
+        return _error('Error: Expected a list of job IDs')
+    if _states is not None and (
+            not isinstance(_states, list) or
+            not all(isinstance(_state, basestring) for _state in _states)):
+        return _error('Error: Expected a list of states')
+    if _before is not None and (
+            isinstance(_before, bool) or
+            not isinstance(_before, (int, float))):
+        return _error('Error: Expected a timestamp as "before"')
+    for _key in ('service', 'prefix'):
+        if not isinstance(_request.get(_key, ''), basestring):
+            return _error('Error: Expected a string as "%s"' % _key)
+
+    _results = Server.bulk(action, _ids, _request.get('service'), _states,
+                           _before, _request.get('prefix'), _dry_run)
+    if not isinstance(_results, dict):
+        return _error(_results)
+    if _v3():
+        return Api.document({'dry_run': _dry_run, 'jobs': dict(
+            (_id, Api.error_data(_result) if _result.startswith('Error:')
+             else {'result': _result})
+            for _id, _result in _results.items()
+        )})
+    return Response(json.dumps(_results), mimetype='application/json')
+
+
+@app.route('/stats')
+def stats():
+    """
+    Job statistics request. Expects GET request on /stats URL. Returns JSON
+    object with number of jobs per state and service ("counts"), per state
+    ("totals"), number of jobs, age of the oldest job and age percentiles (in
+    seconds) for jobs in new, waiting and queued states ("ages", only with
+    the state index enabled), the age of these statistics ("snapshot_age")
+    and, when retention is configured, retention sweeper statistics
+    ("retention": time of the last sweep, number of jobs marked for removal
+    per service, directory sizes).
+    """
+    return Response(json.dumps(Server.stats()),
+                    mimetype='application/json')
+
+
+@app.route('/metrics')
+def metrics():
+    """
+    Metrics request. Expects GET request on /metrics URL. Returns gateway
+    metrics (requests latency, file system operations, number of jobs per
+    state and service) in the Prometheus text format.
     """
-    return Server.kill(id)
+    return Response(Metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,189 @@
+"""
+Shared watcher of job state changes used to implement long-poll and
+Server-Sent-Events requests.
+
+A single background thread periodically resolves the status of all watched
+jobs using :py:func:`Server.status_many` and wakes up waiting clients. The
+cost of watching does not depend on the number of waiting clients, only on
+the number of distinct jobs being watched. A few watched jobs are checked
+separately, the state directories are listed only when more than
+gate_lookup_batch_min jobs are watched (or not at all with the state index).
+"""
+
+import time
+import threading
+
+from logging import debug, error
+from string import capitalize
+
+from CISAppGateway import Server
+from CISAppGateway.Config import conf
+
+#: Statuses reported for jobs that did not finish yet
+ACTIVE_STATUSES = frozenset(
+    capitalize(_state) for _state in (
+        'new', 'waiting', 'processing', 'queued', 'running', 'closing',
+        'cleanup',
+    )
+)
+
+
+def is_active(status):
+    """
+    Check if status string describes a job that can still change its state.
+    """
+    return status in ACTIVE_STATUSES
+
+
+class Watcher(object):
+    """
+    Keeps track of the last known status of watched jobs.
+
+    Waiting clients block on a condition variable without a timeout (cheap
+    for large numbers of idle connections) and are woken up after every poll
+    of the job states. Each client then checks if any of its jobs changed or
+    if its deadline has passed.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        #: Job ID -> number of clients watching the job
+        self.watched = {}
+        #: Job ID -> last known status
+        self.statuses = {}
+        self.thread = None
+
+    def start(self):
+        """
+        Start the poll thread. Has to be called with the condition lock held.
+        """
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name="Watcher")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """
+        Poll loop run by the background thread.
+        """
+        while True:
+            time.sleep(conf.gate_watch_interval)
+            with self.condition:
+                _ids = list(self.watched)
+            _current = {}
+            if _ids:
+                try:
+                    _current = Server.status_many(_ids)
+                except:
+                    error("@Watcher - Unable to poll job states",
+                          exc_info=True)
+            with self.condition:
+                for _id, _status in _current.items():
+                    if _id in self.watched:
+                        self.statuses[_id] = _status
+                self.condition.notify_all()
+
+    def register(self, ids):
+        """
+        Start watching jobs. Status of jobs not watched by any other client
+        is checked immediately.
+
+        :param ids: list of job IDs
+        """
+        with self.condition:
+            self.start()
+            for _id in ids:
+                self.watched[_id] = self.watched.get(_id, 0) + 1
+            _unknown = [_id for _id in ids if _id not in self.statuses]
+        if _unknown:
+            _current = Server.status_many(_unknown)
+            with self.condition:
+                for _id, _status in _current.items():
+                    if _id in self.watched:
+                        self.statuses.setdefault(_id, _status)
+
+    def unregister(self, ids):
+        """
+        Stop watching jobs.
+
+        :param ids: list of job IDs previously passed to
+            :py:meth:`register`
+        """
+        with self.condition:
+            for _id in ids:
+                self.watched[_id] -= 1
+                if not self.watched[_id]:
+                    del self.watched[_id]
+                    self.statuses.pop(_id, None)
+
+    def wait(self, since, timeout):
+        """
+        Wait until status of any of the jobs differs from the one known by the
+        client.
+
+        :param since: dict mapping job IDs to the last status known by the
+            client (*None* when unknown).
+        :param timeout: maximum time to wait in seconds.
+        :return: dict mapping job IDs to their current statuses.
+        """
+        _ids = list(since)
+        try:
+            self.register(_ids)
+            return self._wait(since, timeout)
+        finally:
+            self.unregister(_ids)
+
+    def _wait(self, since, timeout):
+        """
+        Implementation of :py:meth:`wait` for already registered jobs.
+        """
+        _deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                _current = dict(
+                    (_id, self.statuses.get(_id)) for _id in since
+                )
+                for _id, _status in _current.items():
+                    if _status is not None and _status != since[_id]:
+                        return _current
+                if time.time() >= _deadline:
+                    return _current
+                self.condition.wait()
+
+    def events(self, since, keepalive):
+        """
+        Generate job status change events until all jobs finish.
+
+        :param since: dict mapping job IDs to the last status known by the
+            client (*None* when unknown).
+        :param keepalive: maximum time between two yielded items in seconds.
+        :return: generator of (job ID, status) tuples. *None* is yielded when
+            nothing changed within keepalive period.
+        """
+        _ids = list(since)
+        _since = dict(since)
+        try:
+            self.register(_ids)
+            while _since:
+                _current = self._wait(_since, keepalive)
+                _changed = False
+                for _id, _status in _current.items():
+                    if _status is None or _status == _since[_id]:
+                        continue
+                    _changed = True
+                    debug("@Watcher - Job %s changed status: %s",
+                          _id, _status)
+                    yield _id, _status
+                    if is_active(_status):
+                        _since[_id] = _status
+                    else:
+                        del _since[_id]
+                if not _changed:
+                    yield None
+        finally:
+            self.unregister(_ids)
+
+
+#: Global Watcher instance
+watcher = Watcher()
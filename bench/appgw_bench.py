@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+"""
+Reproducible benchmark of AppGateway request handling.
+
+Creates a shared storage tree (use a tmpfs directory, e.g. /dev/shm, to
+measure the gateway itself rather than the disk) with a requested number of
+existing jobs, starts a fake AppServer moving jobs through the
+new -> queued -> running -> done states and drives the Flask application with
+a configurable mix of /submit, /status, /progress, /kill and /delete
+requests.
+
+Requests are measured after a warm-up (state index scan, caches). Reports
+throughput, p50/p99 latency and number of storage operations per request
+(calls of :py:func:`CISAppGateway.Storage.offload`, a single operation can
+make more than one system call). Results are appended as JSON lines to the
+output file and can be compared with the last baseline record run with the
+same parameters to catch regressions:
+
+    python bench/appgw_bench.py --jobs 100000 --requests 20000 \\
+        --mix status=80,progress=10,submit=5,kill=5 \\
+        --output bench/results.jsonl --compare bench/baseline.jsonl
+
+Gateway configuration options can be overridden with --set, e.g.
+--set gate_state_index=true.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from CISAppGateway import app, Storage
+from CISAppGateway.Config import conf
+from CISAppGateway.Index import index
+
+#: Distribution of pre-existing jobs among states
+STATE_DISTRIBUTION = (
+    ('new', 0.02), ('waiting', 0.01), ('queued', 0.05), ('running', 0.05),
+    ('done', 0.70), ('failed', 0.10), ('aborted', 0.02), ('killed', 0.05),
+)
+TERMINAL_STATES = ('done', 'failed', 'aborted', 'killed')
+SERVICES = ('Test', 'MultiNest', 'EPRCore')
+#: Statistics compared with the baseline
+COMPARED = ('p50', 'p99', 'storage_ops_per_request')
+#: Minimal number of requests of an operation needed to compare its p99
+P99_MIN_REQUESTS = 1000
+
+
+def create_tree(root, options):
+    """
+    Create shared storage and output directories and load gateway
+    configuration using them.
+    """
+    _shared = os.path.join(root, 'Shared')
+    _output = os.path.join(root, 'Output')
+    for _subdir in ('jobs', 'opts', 'flags/delete', 'flags/stop',
+                    'flags/old_api') + conf.service_states:
+        os.makedirs(os.path.join(_shared, _subdir))
+    os.makedirs(_output)
+
+    _conf = {
+        'gate_path_shared': _shared,
+        'gate_path_output': _output,
+    }
+    _conf.update(options)
+    _conf_name = os.path.join(root, 'bench.json')
+    with open(_conf_name, 'w') as _conf_file:
+        json.dump(_conf, _conf_file)
+    conf.load(_conf_name)
+
+
+def populate(count, seed):
+    """
+    Create count jobs distributed among states according to
+    STATE_DISTRIBUTION.
+
+    :return: list of created job IDs
+    """
+    _random = random.Random(seed)
+    _states = [_state for _state, _ in STATE_DISTRIBUTION]
+    _weights = [_weight for _, _weight in STATE_DISTRIBUTION]
+    _ids = []
+    for _idx in range(count):
+        _service = SERVICES[_idx % len(SERVICES)]
+        _uuid = uuid.UUID(int=_random.getrandbits(128))
+        _jid = '%s_%s_bench' % (_service, _uuid)
+        _state = _weighted_choice(_random, _states, _weights)
+        _create_job(_jid, _state)
+        _ids.append(_jid)
+    return _ids
+
+
+def _weighted_choice(rnd, items, weights):
+    _point = rnd.random() * sum(weights)
+    for _item, _weight in zip(items, weights):
+        _point -= _weight
+        if _point <= 0:
+            return _item
+    return items[-1]
+
+
+def _create_job(jid, state):
+    _name = _prepare(conf.job_path(conf.gate_path_jobs, jid))
+    with open(_name, 'w') as _file:
+        _file.write('{"service": "Test", "api": 2.0}')
+    os.symlink(_name, _prepare(conf.job_path(conf.gate_path[state], jid)))
+    if state in ('running',) + TERMINAL_STATES:
+        _write_output(jid, state)
+
+
+def _write_output(jid, state):
+    _out_dir = os.path.join(conf.gate_path_output, jid)
+    if not os.path.isdir(_out_dir):
+        os.mkdir(_out_dir)
+    with open(os.path.join(_out_dir, 'progress.log'), 'a') as _log:
+        _log.write('Progress of %s: %s\n' % (jid, state))
+    if state in TERMINAL_STATES:
+        _name = conf.job_path(conf.gate_path_opts, jid, 'message_' + jid)
+        with open(_prepare(_name), 'w') as _message:
+            _message.write('%s: benchmark\n' % state.capitalize())
+
+
+def _prepare(path):
+    """
+    Create hash-prefix subdirectory of a job entry (sharded layout).
+    """
+    _dir = os.path.dirname(path)
+    if not os.path.isdir(_dir):
+        os.makedirs(_dir)
+    return path
+
+
+class FakeAppServer(threading.Thread):
+    """
+    Moves jobs through new -> queued -> running -> done states, kills jobs
+    marked with stop flag and removes jobs marked for deletion.
+    """
+
+    def __init__(self, rate):
+        """
+        :param rate: number of state transitions per second.
+        """
+        super(FakeAppServer, self).__init__(name='FakeAppServer')
+        self.daemon = True
+        self.rate = rate
+        self.stopped = threading.Event()
+        self.transitions = 0
+
+    def run(self):
+        _pipeline = (('running', 'done'), ('queued', 'running'),
+                     ('new', 'queued'))
+        while not self.stopped.is_set():
+            _start = time.time()
+            _budget = max(1, int(self.rate))
+            for _jid in Storage.list_jobs(conf.gate_path_flag_delete):
+                self._remove(_jid)
+            for _jid in Storage.list_jobs(conf.gate_path_flag_stop):
+                for _state in ('new', 'queued', 'running'):
+                    if self._move(_jid, _state, 'killed'):
+                        _write_output(_jid, 'killed')
+                        break
+                os.unlink(conf.job_path(conf.gate_path_flag_stop, _jid))
+            for _source, _target in _pipeline:
+                for _jid in Storage.list_jobs(conf.gate_path[_source]):
+                    if _budget <= 0:
+                        break
+                    if self._move(_jid, _source, _target):
+                        _budget -= 1
+                        if _target in ('running', 'done'):
+                            _write_output(_jid, _target)
+            self.stopped.wait(max(0, 1 - (time.time() - _start)))
+
+    def _move(self, jid, source, target):
+        try:
+            os.rename(conf.job_path(conf.gate_path[source], jid),
+                      _prepare(conf.job_path(conf.gate_path[target], jid)))
+        except OSError:
+            return False
+        self.transitions += 1
+        return True
+
+    def _remove(self, jid):
+        """
+        Remove all entries and output of a job (the delete flag last).
+        """
+        _paths = [conf.job_path(conf.gate_path[_state], jid)
+                  for _state in conf.service_states]
+        _paths += [
+            conf.job_path(conf.gate_path_opts, jid, 'message_' + jid),
+            conf.job_path(conf.gate_path_flag_stop, jid),
+            conf.job_path(conf.gate_path_flag_old_api, jid),
+            conf.job_path(conf.gate_path_jobs, jid),
+            conf.job_path(conf.gate_path_flag_delete, jid),
+        ]
+        shutil.rmtree(os.path.join(conf.gate_path_output, jid),
+                      ignore_errors=True)
+        for _path in _paths:
+            try:
+                os.unlink(_path)
+            except OSError:
+                pass
+
+
+class Driver(threading.Thread):
+    """
+    Client sending requests according to the request mix.
+    """
+
+    def __init__(self, ids, mix, count, seed):
+        super(Driver, self).__init__(name='Driver')
+        self.ids = ids
+        self.mix = mix
+        self.count = count
+        self.random = random.Random(seed)
+        #: operation -> list of (latency, storage operations)
+        self.samples = dict((_op, []) for _op in mix)
+
+    def run(self):
+        _client = app.test_client()
+        _ops = list(self.mix)
+        _weights = [self.mix[_op] for _op in _ops]
+        for _ in range(self.count):
+            _op = _weighted_choice(self.random, _ops, _weights)
+            _start = time.time()
+            if _op == 'submit':
+                _response = _client.post(
+                    '/submit',
+                    data=json.dumps({'service': 'Test', 'api': 2.0}),
+                    headers={'Content-Type': 'application/json'})
+                self.ids.append(_response.get_data())
+            else:
+                _jid = self.random.choice(self.ids)
+                _response = _client.get('/%s/%s' % (_op, _jid))
+                _response.get_data()
+            self.samples[_op].append((time.time() - _start,
+                                      Storage.operations()))
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    _values = sorted(values)
+    return _values[min(len(_values) - 1, int(fraction * len(_values)))]
+
+
+def summarize(drivers, duration):
+    """
+    Compute per operation and total statistics.
+    """
+    _samples = {}
+    for _driver in drivers:
+        for _op, _values in _driver.samples.items():
+            _samples.setdefault(_op, []).extend(_values)
+    _samples['total'] = sum(_samples.values(), [])
+
+    _result = {}
+    for _op, _values in sorted(_samples.items()):
+        _latencies = [_latency for _latency, _ in _values]
+        _storage_ops = [_count for _, _count in _values]
+        _result[_op] = {
+            'requests': len(_values),
+            'throughput': len(_values) / duration if duration else None,
+            'p50': percentile(_latencies, 0.5),
+            'p99': percentile(_latencies, 0.99),
+            'storage_ops_per_request':
+                float(sum(_storage_ops)) / len(_storage_ops)
+                if _storage_ops else None,
+        }
+    return _result
+
+
+def compare(result, baseline_name, threshold, min_delta):
+    """
+    Compare result with the last record of a baseline file run with the same
+    parameters. Latency changes smaller than min_delta seconds and p99 of
+    operations with less than :py:data:`P99_MIN_REQUESTS` requests (too few
+    samples) are not reported as regressions.
+
+    :return: list of regression descriptions
+    """
+    _records = []
+    if os.path.exists(baseline_name):
+        with open(baseline_name) as _baseline_file:
+            _records = [json.loads(_line) for _line in _baseline_file
+                        if _line.strip()]
+    _baseline = None
+    for _record in reversed(_records):
+        if _record.get('params') == result['params']:
+            _baseline = _record
+            break
+    if _baseline is None:
+        print('No baseline record with the same parameters in %s' %
+              baseline_name)
+        return []
+    _regressions = []
+    for _op, _stats in sorted(result['results'].items()):
+        _base = _baseline['results'].get(_op)
+        if _base is None:
+            continue
+        for _key in COMPARED:
+            if not _base.get(_key) or _stats.get(_key) is None:
+                continue
+            _ratio = _stats[_key] / _base[_key]
+            print('%-10s %-24s %12.6g -> %12.6g (%+.1f%%)' % (
+                _op, _key, _base[_key], _stats[_key], (_ratio - 1) * 100))
+            if _ratio <= 1 + threshold:
+                continue
+            if _key in ('p50', 'p99') and \
+                    _stats[_key] - _base[_key] < min_delta:
+                continue
+            if _key == 'p99' and \
+                    min(_stats['requests'], _base['requests']) < \
+                    P99_MIN_REQUESTS:
+                continue
+            _regressions.append('%s %s' % (_op, _key))
+    return _regressions
+
+
+def warm_up(ids, mix, count, seed):
+    """
+    Load the state index (when enabled) and send count requests that are not
+    measured, so caches are filled before the measurement starts.
+    """
+    if conf.gate_state_index:
+        index.start()
+    if count:
+        _driver = Driver(ids, mix, count, seed)
+        _driver.run()
+
+
+def parse_mix(mix):
+    _result = {}
+    for _item in mix.split(','):
+        _op, _weight = _item.split('=')
+        if _op not in ('submit', 'status', 'progress', 'kill', 'delete'):
+            raise ValueError('Unsupported operation: %s' % _op)
+        _result[_op] = float(_weight)
+    return _result
+
+
+def parse_options(options):
+    _result = {}
+    for _option in options:
+        _key, _value = _option.split('=', 1)
+        try:
+            _result[_key] = json.loads(_value)
+        except ValueError:
+            _result[_key] = _value
+    return _result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    _parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    _parser.add_argument('--root', help='directory for the shared storage '
+                         'tree (default: new temporary directory)')
+    _parser.add_argument('--jobs', type=int, default=1000,
+                         help='number of pre-existing jobs')
+    _parser.add_argument('--requests', type=int, default=10000,
+                         help='number of requests per client')
+    _parser.add_argument('--clients', type=int, default=1,
+                         help='number of concurrent clients')
+    _parser.add_argument('--mix', default='status=80,progress=10,submit=5,'
+                         'kill=5', help='request mix')
+    _parser.add_argument('--rate', type=float, default=100,
+                         help='fake AppServer state transitions per second')
+    _parser.add_argument('--seed', type=int, default=0)
+    _parser.add_argument('--warmup', type=int, default=200,
+                         help='number of requests sent before measuring')
+    _parser.add_argument('--set', action='append', default=[],
+                         metavar='KEY=VALUE',
+                         help='override gateway configuration option')
+    _parser.add_argument('--output', help='append results to a JSON lines '
+                         'file')
+    _parser.add_argument('--compare', help='compare results with the last '
+                         'record of a JSON lines file')
+    _parser.add_argument('--threshold', type=float, default=0.2,
+                         help='relative increase reported as regression')
+    _parser.add_argument('--min-delta', type=float, default=0.0002,
+                         help='minimal latency increase (in seconds) '
+                         'reported as regression')
+    _args = _parser.parse_args()
+
+    _root = _args.root or tempfile.mkdtemp(prefix='appgw_bench_')
+    _options = parse_options(_args.set)
+    _mix = parse_mix(_args.mix)
+    try:
+        create_tree(_root, _options)
+        logging.getLogger().setLevel(logging.ERROR)
+        _start = time.time()
+        _ids = populate(_args.jobs, _args.seed)
+        print('Created %d jobs in %.1fs' % (_args.jobs, time.time() - _start))
+
+        _appserver = FakeAppServer(_args.rate)
+        _appserver.start()
+        warm_up(_ids, _mix, _args.warmup, _args.seed - 1)
+        _drivers = [
+            Driver(_ids, _mix, _args.requests, _args.seed + _idx)
+            for _idx in range(_args.clients)
+        ]
+        _start = time.time()
+        for _driver in _drivers:
+            _driver.start()
+        for _driver in _drivers:
+            _driver.join()
+        _duration = time.time() - _start
+        _appserver.stopped.set()
+        _appserver.join()
+    finally:
+        if not _args.root:
+            shutil.rmtree(_root, ignore_errors=True)
+
+    _result = {
+        'time': time.time(),
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'params': {
+            'jobs': _args.jobs, 'requests': _args.requests,
+            'clients': _args.clients, 'mix': _mix, 'rate': _args.rate,
+            'seed': _args.seed, 'warmup': _args.warmup, 'options': _options,
+        },
+        'duration': _duration,
+        'transitions': _appserver.transitions,
+        'results': summarize(_drivers, _duration),
+    }
+    for _op, _stats in sorted(_result['results'].items()):
+        if not _stats['requests']:
+            continue
+        print('%-10s %8d req %10.1f req/s  p50 %8.3f ms  p99 %8.3f ms  '
+              '%6.2f storage ops/req' % (
+                  _op, _stats['requests'], _stats['throughput'],
+                  _stats['p50'] * 1000, _stats['p99'] * 1000,
+                  _stats['storage_ops_per_request']))
+    # Compare before the output is written, it can be the baseline file
+    _regressions = []
+    if _args.compare:
+        _regressions = compare(_result, _args.compare, _args.threshold,
+                               _args.min_delta)
+    if _args.output:
+        with open(_args.output, 'a') as _output:
+            _output.write(json.dumps(_result, sort_keys=True) + '\n')
+    if _regressions:
+        print('Regressions: %s' % ', '.join(_regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()